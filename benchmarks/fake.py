@@ -0,0 +1,85 @@
+"""
+In memory stand in for a MongoClient.
+
+Collections accept every write a handler makes and only count them, so
+benchmarks measure mongolog's own cost: building the log record, grouping
+batches and building the upserts.  BSON encoding and the round trip to
+mongod are only measured with a real connection.
+"""
+from collections import defaultdict
+
+
+class FakeCollection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        # calls and documents written per method
+        self.calls = defaultdict(int)
+        self.documents = defaultdict(int)
+
+    def _write(self, method, documents=1):
+        self.calls[method] += 1
+        self.documents[method] += documents
+
+    def insert_one(self, document):
+        self._write('insert_one')
+
+    def insert_many(self, documents, ordered=True):
+        self._write('insert_many', len(documents))
+
+    def update_one(self, filter, update, upsert=False):
+        self._write('update_one')
+
+    def replace_one(self, filter, replacement, upsert=False):
+        self._write('replace_one')
+
+    def bulk_write(self, requests, ordered=True):
+        self._write('bulk_write', len(requests))
+
+    def create_index(self, keys, **kwargs):
+        return kwargs.get('name') or '_'.join('%s_%s' % key for key in keys)
+
+    def index_information(self):
+        return {'_id_': {'key': [('_id', 1)]}}
+
+    def options(self):
+        return {}
+
+    def stats(self):
+        return {'calls': dict(self.calls), 'documents': dict(self.documents)}
+
+
+class FakeDatabase(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self, name)
+        return self.collections[name]
+
+    def get_collection(self, name, **kwargs):
+        return self[name]
+
+    def create_collection(self, name, **kwargs):
+        return self[name]
+
+
+class FakeClient(object):
+    VERSION = [3, 6, 0, 0]
+
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = FakeDatabase(self, name)
+        return self.databases[name]
+
+    def server_info(self):
+        return {'versionArray': self.VERSION}
+
+    def drop_database(self, name):
+        self.databases.pop(name, None)
@@ -0,0 +1,77 @@
+"""
+The emit() hot path the way it used to be written.
+
+Kept only so benchmarks/run.py can time the old and new implementations side
+by side: -b embedded_upsert, -b normalize and -b sanitize.
+"""
+import json
+
+from mongolog.handlers import SimpleMongoLogHandler
+from mongolog.models import LogRecord
+from mongolog.records import KeySanitizer
+
+
+class ReadThenWriteHandler(SimpleMongoLogHandler):
+    """
+    insert_embedded() before it was a single upsert: find().count() then insert_one or update_one
+    """
+    def insert_embedded(self, log_record):
+        query = {'uuid': log_record['uuid']}
+        if self.mongolog.find(query).count() == 0:
+            log_record['created'] = log_record.pop('time')
+            log_record['counter'] = 1
+            self.mongolog.insert_one(log_record)
+        else:
+            self.mongolog.update_one(query, {
+                "$push": {'dates': {'$each': [log_record['time']], "$slice": -self.max_keep}},
+                "$inc": {'counter': 1},
+            })
+
+
+class JsonRoundTripHandler(SimpleMongoLogHandler):
+    """
+    create_log_record() before records were normalized in one pass: a json.dumps/json.loads round trip
+    """
+    def create_log_record(self, record):
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+
+        record = LogRecord(json.loads(json.dumps(record.__dict__, default=str)))
+        record = self.check_keys(record)
+        mongolog_record = LogRecord({
+            'name': record['name'],
+            'thread': record['thread'],
+            'process': record['process'],
+            'level': record['levelname'],
+            'msg': record['msg'],
+            'path': record['pathname'],
+            'module': record['module'],
+            'line': record['lineno'],
+            'func': record['funcName'],
+            'filename': record['filename'],
+        })
+        return self.finish_log_record(mongolog_record, mongolog_record['msg'], record['levelname'])
+
+
+class RecursiveCheckKeys(object):
+    """
+    check_keys() before KeySanitizer: recursion that pops and re-inserts every key
+    """
+    def __init__(self, mongo_version):
+        self.sanitizer = KeySanitizer(mongo_version)
+
+    def check_keys(self, msg):
+        for k, v in list(msg.items()):
+            self._check_keys(k, v, msg)
+        return msg
+
+    def _check_keys(self, k, v, _dict):
+        _dict[self.sanitizer.new_key(k)] = _dict.pop(k)
+        if isinstance(v, dict):
+            for nk, vk in list(v.items()):
+                self._check_keys(nk, vk, v)
+        if isinstance(v, list):
+            for item in v:
+                if isinstance(item, dict):
+                    for nk, vk in list(item.items()):
+                        self._check_keys(nk, vk, item)
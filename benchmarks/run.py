@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks of the emit() hot path.
+
+Each benchmark times one piece of emit() on its own, over a range of msg
+sizes and nesting depths, and reports ops/sec, mean, p50 and p99 as json:
+
+    create_log_record  Simple and Verbose handlers.  Includes check_keys and the uuid
+    check_keys         Sanitizing msg keys, with and without keys mongo rejects
+    uuid               fingerprint() of a msg, uncached and as a FingerprintCache hit
+    write              write_log_record() and batched write_log_records() of each record_type
+    emit               logger.info() through the handler, end to end
+
+and the old implementations (benchmarks/legacy.py) against the ones that replaced them:
+
+    embedded_upsert    find().count() then insert/update vs a single upsert.  Needs --connection
+    normalize          create_log_record() with a json round trip vs normalize()
+    sanitize           recursive check_keys() vs KeySanitizer
+
+By default handlers write to the in memory backend in benchmarks/fake.py, so
+only mongolog's own cost is measured and the numbers can be compared across
+versions on the same machine.  --connection writes to a mongod instead, in the
+'mongolog_bench' database, which is dropped afterwards.
+
+Usage:
+    python benchmarks/run.py -o before.json
+    python benchmarks/run.py -b write -b emit --connection mongodb://localhost:27017
+    python benchmarks/run.py -o after.json --compare before.json
+"""
+from __future__ import print_function
+import argparse
+import copy
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pymongo  # noqa: E402
+
+from fake import FakeClient  # noqa: E402
+from legacy import JsonRoundTripHandler, ReadThenWriteHandler, RecursiveCheckKeys  # noqa: E402
+from mongolog.clients import get_client  # noqa: E402
+from mongolog.handlers import SimpleMongoLogHandler, VerboseMongoLogHandler  # noqa: E402
+from mongolog.metrics import clock  # noqa: E402
+from mongolog.models import LogRecord  # noqa: E402
+from mongolog.records import FingerprintCache, KeySanitizer, fingerprint, normalize  # noqa: E402
+
+DATABASE = 'mongolog_bench'
+
+HANDLERS = [('simple', SimpleMongoLogHandler), ('verbose', VerboseMongoLogHandler)]
+
+# (record_type, timestamp_layout)
+WRITE_PATHS = [('embedded', 'documents'), ('reference', 'documents'), ('reference', 'buckets'), ('capped', 'documents')]
+
+# (keys, depth) of the msgs.  0 keys is a plain string msg.
+SHAPES = [(0, 1)] + [(keys, depth) for keys in (10, 100, 1000) for depth in (1, 4, 16)]
+
+# Number of distinct uuids the write and emit benchmarks cycle through
+DISTINCT = 10
+
+
+class FakeBackend(object):
+    """
+    Mixed into a handler class so it connects to a FakeClient instead of mongod
+    """
+    def connect_pymongo3(self, test=False):
+        self.client = FakeClient()
+        return self.client
+
+
+def payload(keys, depth=1, dirty=False, n=0):
+    """
+    A request like msg with 'keys' leaf values, nested 'depth' dicts deep.
+    dirty adds keys mongo won't store.  n makes a distinct msg (and uuid).
+    """
+    if not keys:
+        return "Just some friendly info %s" % n
+
+    when = datetime.datetime(2024, 1, 1, 12, 30)
+    leaves = dict(
+        ('field_%s' % i, ['value %s' % i, i, [i, str(i), None], (i, 'a'), when][i % 5])
+        for i in range(keys)
+    )
+    leaves['n'] = n
+    if dirty:
+        leaves['query'] = {'$or': [{'price.usd': {'$lt': 10}}, {'qty': {'$gt': 100}}]}
+
+    msg = leaves
+    for level in range(depth - 1):
+        msg = {'path': '/api/v1/items/', 'level_%s' % level: msg}
+    return msg
+
+
+def make_record(msg):
+    return logging.getLogger('mongolog.bench').makeRecord('mongolog.bench', logging.INFO, __file__, 1, msg, None, None)
+
+
+def make_handler(handler_class, options, **kwargs):
+    if not options.connection:
+        handler_class = type('Fake%s' % handler_class.__name__, (FakeBackend, handler_class), {})
+        return handler_class(connection='fake://', database=DATABASE, **kwargs)
+
+    handler = handler_class(connection=options.connection, database=DATABASE, **kwargs)
+    # Start from empty collections
+    handler.client.drop_database(DATABASE)
+    handler.setup_collections()
+    return handler
+
+
+def close_handler(handler):
+    handler.close()
+    handler.client.drop_database(DATABASE)
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+
+def measure(func, prepare, options, records=1):
+    """
+    Time func(prepare(i)) options.iterations times, after options.warmup untimed calls.
+
+    prepare() isn't timed, so it can copy what func modifies.  The garbage collector
+    is off while timing, like timeit does, so a collection doesn't land in one sample.
+    """
+    samples = []
+    gc.collect()
+    gc.disable()
+    try:
+        for i in range(options.warmup + options.iterations):
+            arg = prepare(i)
+            start = clock()
+            func(arg)
+            if i >= options.warmup:
+                samples.append(clock() - start)
+    finally:
+        gc.enable()
+
+    samples.sort()
+    total = sum(samples)
+    result = {
+        'iterations': len(samples),
+        'ops_per_sec': len(samples) / total,
+        'mean_us': total / len(samples) * 1e6,
+        'p50_us': percentile(samples, 50) * 1e6,
+        'p99_us': percentile(samples, 99) * 1e6,
+    }
+    if records > 1:
+        result['records_per_sec'] = len(samples) * records / total
+    return result
+
+
+def bench_create_log_record(options):
+    for name, handler_class in HANDLERS:
+        handler = make_handler(handler_class, options)
+        for keys, depth in SHAPES:
+            record = make_record(payload(keys, depth))
+            yield {'handler': name, 'keys': keys, 'depth': depth}, measure(handler.create_log_record, lambda i: record, options)
+        close_handler(handler)
+
+
+def bench_check_keys(options):
+    handler = make_handler(SimpleMongoLogHandler, options)
+    for keys, depth in SHAPES[1:]:
+        for dirty in (False, True):
+            msg = normalize(payload(keys, depth, dirty))
+            # check_keys rewrites the msg in place so every call gets its own copy
+            result = measure(handler.check_keys, lambda i: {'msg': copy.deepcopy(msg)}, options)
+            yield {'keys': keys, 'depth': depth, 'dirty': dirty}, result
+    close_handler(handler)
+
+
+def bench_uuid(options):
+    for keys, depth in SHAPES:
+        msg = normalize(payload(keys, depth))
+        yield {'keys': keys, 'depth': depth, 'cache': 'miss'}, measure(lambda msg: fingerprint(msg, 'INFO'), lambda i: msg, options)
+
+        cache = FingerprintCache()
+        cache.uuid(msg, 'INFO')
+        yield {'keys': keys, 'depth': depth, 'cache': 'hit'}, measure(lambda msg: cache.uuid(msg, 'INFO'), lambda i: msg, options)
+
+
+def copies(templates, i, batch):
+    """
+    The i-th batch of fresh copies of the template log records.  A single record if batch is 1.
+    Writes may add an _id to the records they're given.
+    """
+    records = [LogRecord(templates[j % len(templates)]) for j in range(i * batch, (i + 1) * batch)]
+    return records[0] if batch == 1 else records
+
+
+def bench_write(options):
+    for record_type, layout in WRITE_PATHS:
+        handler = make_handler(SimpleMongoLogHandler, options, record_type=record_type, timestamp_layout=layout)
+        for keys in (10, 1000):
+            templates = [handler.create_log_record(make_record(payload(keys, n=n))) for n in range(DISTINCT)]
+            for batch in (1, 100):
+                params = {'record_type': record_type, 'timestamp_layout': layout, 'keys': keys, 'batch': batch}
+                write = handler.write_log_record if batch == 1 else handler.write_log_records
+                result = measure(lambda arg: handler.guard(write, arg), lambda i: copies(templates, i, batch), options, records=batch)
+                yield params, result
+        close_handler(handler)
+
+
+def bench_emit(options):
+    for name, handler_class in HANDLERS:
+        for record_type in ('embedded', 'reference', 'capped'):
+            for queued in (False, True):
+                handler = make_handler(handler_class, options, record_type=record_type, queued=queued)
+                logger = logging.getLogger('mongolog.bench.emit')
+                logger.propagate = False
+                logger.setLevel(logging.DEBUG)
+                logger.addHandler(handler)
+                for keys in (0, 100):
+                    msgs = [payload(keys, n=n) for n in range(DISTINCT)]
+                    params = {'handler': name, 'record_type': record_type, 'queued': queued, 'keys': keys}
+                    yield params, measure(logger.info, lambda i: msgs[i % DISTINCT], options)
+                logger.removeHandler(handler)
+                close_handler(handler)
+
+
+def bench_embedded_upsert(options):
+    if not options.connection:
+        # The in memory backend doesn't look documents up, so the read would cost nothing
+        print("embedded_upsert needs --connection.  Skipped", file=sys.stderr)
+        return
+
+    for name, handler_class in [('read-then-write', ReadThenWriteHandler), ('upsert', SimpleMongoLogHandler)]:
+        handler = make_handler(handler_class, options, record_type='embedded')
+        logger = logging.getLogger('mongolog.bench.%s' % handler_class.__name__)
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        msgs = [payload(10, n=n) for n in range(DISTINCT)]
+        yield {'implementation': name}, measure(logger.info, lambda i: msgs[i % DISTINCT], options)
+        logger.removeHandler(handler)
+        close_handler(handler)
+
+
+def bench_normalize(options):
+    for name, handler_class in [('json round trip', JsonRoundTripHandler), ('normalize', SimpleMongoLogHandler)]:
+        handler = make_handler(handler_class, options)
+        for keys, depth in SHAPES:
+            record = make_record(payload(keys, depth))
+            result = measure(handler.create_log_record, lambda i: record, options)
+            yield {'implementation': name, 'keys': keys, 'depth': depth}, result
+        close_handler(handler)
+
+
+def bench_sanitize(options):
+    for mongo_version in (3.4, 3.6):
+        implementations = [
+            ('recursive', RecursiveCheckKeys(mongo_version).check_keys),
+            ('sanitizer', KeySanitizer(mongo_version).sanitize),
+        ]
+        for keys in (10, 100, 1000):
+            for depth in (1, 16):
+                for dirty in (False, True):
+                    msg = normalize(payload(keys, depth, dirty))
+                    for name, check_keys in implementations:
+                        params = {'implementation': name, 'mongo': mongo_version, 'keys': keys, 'depth': depth, 'dirty': dirty}
+                        # Both rewrite the msg in place
+                        yield params, measure(check_keys, lambda i: copy.deepcopy(msg), options)
+
+
+BENCHMARKS = [
+    ('create_log_record', bench_create_log_record),
+    ('check_keys', bench_check_keys),
+    ('uuid', bench_uuid),
+    ('write', bench_write),
+    ('emit', bench_emit),
+    ('embedded_upsert', bench_embedded_upsert),
+    ('normalize', bench_normalize),
+    ('sanitize', bench_sanitize),
+]
+
+
+def environment(options):
+    backend = 'fake'
+    if options.connection:
+        version = get_client(options.connection).server_info()['version']
+        backend = 'mongod %s' % version
+    return {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'backend': backend,
+        'iterations': options.iterations,
+        'warmup': options.warmup,
+        'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+        'pymongo': pymongo.version,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+    }
+
+
+def result_key(result):
+    return result['benchmark'], json.dumps(result['params'], sort_keys=True)
+
+
+def report(result, baseline):
+    """
+    Print a result to stderr, and its change in ops/sec against the baseline run
+    """
+    change = ''
+    previous = baseline.get(result_key(result))
+    if previous:
+        change = '%+.1f%%' % ((result['ops_per_sec'] / previous['ops_per_sec'] - 1) * 100)
+    params = ' '.join('%s=%s' % item for item in sorted(result['params'].items()))
+    print("%-18s %-62s %12.0f %10.1f %10.1f %8s" % (
+        result['benchmark'], params, result['ops_per_sec'], result['p50_us'], result['p99_us'], change), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('-b', '--benchmark', action='append', choices=[name for name, bench in BENCHMARKS],
+                        help='Only run this benchmark.  May be repeated.  Default: all of them')
+    parser.add_argument('-n', '--iterations', default=1000, type=int, help='Timed calls per case.  Default: 1000')
+    parser.add_argument('-w', '--warmup', default=100, type=int, help='Untimed calls before each case.  Default: 100')
+    parser.add_argument('--connection', default=None, help='Write to this mongod instead of the in memory backend')
+    parser.add_argument('-o', '--output', default=None, help='Write the json results to this file instead of stdout')
+    parser.add_argument('--compare', default=None, help='json results of an earlier run to compare ops/sec with')
+    options = parser.parse_args()
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = dict((result_key(result), result) for result in json.load(f)['results'])
+
+    print("%-18s %-62s %12s %10s %10s %8s" % ('benchmark', 'params', 'ops/sec', 'p50(us)', 'p99(us)', 'change'), file=sys.stderr)
+    results = []
+    for name, bench in BENCHMARKS:
+        if options.benchmark and name not in options.benchmark:
+            continue
+        for params, result in bench(options):
+            result = dict(result, benchmark=name, params=params)
+            report(result, baseline)
+            results.append(result)
+
+    output = json.dumps({'environment': environment(options), 'results': results}, indent=4, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
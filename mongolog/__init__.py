@@ -20,4 +20,5 @@ from .handlers import (  # noqa
     SimpleMongoLogHandler,
     VerboseMongoLogHandler,
     HttpLogHandler,
+    CollectorLogHandler,
 )
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    django-mongolog.  Simple Mongo based logger for Django
+    Copyright (C) 2015 - John Furr
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import gzip
+import os
+import time
+
+import bson
+from bson import json_util
+
+# bson.encode/decode_all were added in pymongo 3.9
+_encode = getattr(bson, 'encode', None) or bson.BSON.encode
+
+NDJSON = 'ndjson'
+BSON = 'bson'
+FORMATS = [NDJSON, BSON]
+
+
+def backup_path(directory, collection, fmt):
+    """
+    A new backup file name for collection: <database>.<collection>-<YYYYmmddHHMMSS>.<fmt>.gz
+    """
+    return os.path.join(directory, '%s-%s.%s.gz' % (collection.full_name, time.strftime('%Y%m%d%H%M%S'), fmt))
+
+
+def path_format(path):
+    """
+    The format of a backup file written by BackupWriter
+    """
+    return BSON if path.endswith('.%s.gz' % BSON) else NDJSON
+
+
+class BackupWriter(object):
+    """
+    Append documents to a gzip compressed NDJSON (mongo extended json) or BSON file.
+
+    Every write() is a complete gzip member that is flushed to disk before it
+    returns, so the documents can safely be deleted afterwards.  Reopening the
+    same path appends to it, which is how an interrupted purge resumes.
+    mongorestore reads the BSON files once they are gunzip'ed.
+    """
+    def __init__(self, path, fmt=NDJSON):
+        if fmt not in FORMATS:
+            raise ValueError("format must be one of %s" % FORMATS)
+
+        self.path = path
+        self.format = fmt
+        self.written = 0
+
+    def encode(self, document):
+        if self.format == BSON:
+            return _encode(document)
+        return (json_util.dumps(document) + '\n').encode('utf-8')
+
+    def write(self, documents):
+        """
+        Append documents to the file.  Returns the number written.
+        """
+        count = 0
+        with open(self.path, 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='ab') as z:
+                for document in documents:
+                    z.write(self.encode(document))
+                    count += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.written += count
+        return count
+
+
+def read_backup(path):
+    """
+    Yield the documents of a backup file written by BackupWriter
+    """
+    with gzip.open(path, 'rb') as z:
+        if path_format(path) == BSON:
+            for document in bson.decode_file_iter(z):
+                yield document
+        else:
+            for line in z:
+                yield json_util.loads(line.decode('utf-8'))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    django-mongolog.  Simple Mongo based logger for Django
+    Copyright (C) 2015 - John Furr
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import random
+import threading
+import time
+
+from mongolog.exceptions import CircuitOpenError
+
+
+def backoff(attempt, base=0.1, cap=2, rand=random.random):
+    """
+    Seconds to wait before retry number attempt (starting at 0).  Full jitter:
+    a random time between 0 and base * 2 ** attempt, but never more than cap.
+    """
+    return rand() * min(cap, base * 2 ** attempt)
+
+
+class CircuitBreaker(object):
+    """
+    Retry failed writes with jittered exponential backoff and stop calling a
+    backend that keeps failing.
+
+    call(write, arg) retries write up to 'retries' times when it raises one of
+    'retry_on'.  After failure_threshold consecutive failed calls the circuit
+    opens and call() raises CircuitOpenError straight away, without touching the
+    backend.  Once reset_timeout seconds have passed a single call is let
+    through as a probe (half open).  If it succeeds the circuit closes, if it
+    fails the circuit opens again.
+
+    Exceptions that aren't in retry_on are raised as is and don't count as failures.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+            self, failure_threshold=5, reset_timeout=30, retries=2, backoff=0.1, backoff_max=2, retry_on=(Exception,),
+            clock=time.time, sleep=time.sleep):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.retry_on = tuple(retry_on)
+        self.clock = clock
+        self.sleep = sleep
+
+        self.state = self.CLOSED
+        self.opened_at = None
+
+        # Consecutive failed calls.  Reset by a successful call.
+        self.consecutive = 0
+
+        # Counters reported by metrics()
+        self.calls = 0
+        self.failures = 0
+        self.retried = 0
+        self.rejected = 0
+        self.transitions = {}
+
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _change(self, state):
+        """ Must be called with self._lock held """
+        key = '%s->%s' % (self.state, state)
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        self.state = state
+        self.opened_at = self.clock() if state == self.OPEN else self.opened_at
+
+    def allow(self):
+        """
+        Return True if a call may go through.  In the half open state only one probe is let through at a time.
+        """
+        with self._lock:
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                self._change(self.HALF_OPEN)
+
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            self.rejected += 1
+            return False
+
+    def ready(self):
+        """
+        False while the circuit is open and reset_timeout hasn't passed.  Unlike allow() this changes nothing.
+        """
+        return self.state != self.OPEN or self.clock() - self.opened_at >= self.reset_timeout
+
+    def success(self):
+        with self._lock:
+            self._probing = False
+            self.consecutive = 0
+            if self.state != self.CLOSED:
+                self._change(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self._probing = False
+            self.failures += 1
+            self.consecutive += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutive >= self.failure_threshold):
+                self._change(self.OPEN)
+
+    def call(self, write, *args):
+        """
+        Call write(*args) with retries.  Raises CircuitOpenError if the circuit is open.
+        """
+        if not self.allow():
+            raise CircuitOpenError("Circuit open since %s" % time.ctime(self.opened_at))
+
+        self.calls += 1
+        # A half open probe isn't retried.  One failure is enough to open the circuit again.
+        retries = 0 if self.state == self.HALF_OPEN else self.retries
+        attempt = 0
+        while True:
+            try:
+                result = write(*args)
+            except self.retry_on:
+                if attempt >= retries:
+                    self.failure()
+                    raise
+                self.sleep(backoff(attempt, self.backoff, self.backoff_max))
+                self.retried += 1
+                attempt += 1
+            except Exception:
+                # Not a backend failure (e.g. a document mongo won't accept)
+                self.success()
+                raise
+            else:
+                self.success()
+                return result
+
+    def metrics(self):
+        """
+        Return the state and counters as a dict
+        """
+        with self._lock:
+            return {
+                'state': self.state,
+                'opened_at': self.opened_at,
+                'consecutive_failures': self.consecutive,
+                'calls': self.calls,
+                'failures': self.failures,
+                'retries': self.retried,
+                'rejected': self.rejected,
+                'transitions': dict(self.transitions),
+            }
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+    django-mongolog.  Simple Mongo based logger for Django
+    Copyright (C) 2015 - John Furr
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import threading
+
+import pymongo
+
+# (connection, options) -> MongoClient
+_clients = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+
+
+def get_client(connection, **options):
+    """
+    Return the process wide MongoClient for connection and options.
+
+    Every handler, Mongolog.find() and the management commands share one
+    client (and so one connection pool) per connection string and options.
+    MongoClient isn't fork safe so clients created before a fork (gunicorn
+    and uwsgi workers) are forgotten and new ones are created in the child.
+    """
+    global _pid
+    key = (connection, tuple(sorted(options.items())))
+    with _lock:
+        if _pid != os.getpid():
+            # These belong to the parent.  Closing them here could send commands over the parent's sockets.
+            _clients.clear()
+            _pid = os.getpid()
+
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = pymongo.MongoClient(connection, **options)
+        return client
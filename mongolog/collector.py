@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+    django-mongolog.  Simple Mongo based logger for Django
+    Copyright (C) 2015 - John Furr
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import errno
+import os
+import socket
+import stat
+import tempfile
+import time
+from functools import partial
+
+from bson import json_util
+
+from mongolog.exceptions import LogConfigError
+from mongolog.writers import QueuedWriter
+
+# In a directory only this user can use.  A socket in a shared directory could be bound
+# by another user first, who would then receive every worker's log records.
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'mongolog-%s' % os.getuid(), 'mongolog.sock')
+
+# Largest datagram the collector reads.  Linux won't send a bigger one over a unix socket by default anyway.
+MAX_DATAGRAM = 256 * 1024
+
+# Read datetimes back the way they were logged: naive
+_LOADS_OPTIONS = {'json_options': json_util.JSONOptions(tz_aware=False)} if hasattr(json_util, 'JSONOptions') else {}
+
+
+def encode(log_records):
+    """
+    One datagram holding log_records as mongo extended json, one a line
+    """
+    return b''.join((json_util.dumps(log_record) + '\n').encode('utf-8') for log_record in log_records)
+
+
+def truncate(log_record, size):
+    """
+    Encode log_record in at most size bytes by cutting its msg down to the start of
+    its json, and marking it 'truncated'.  None if it doesn't fit even with an empty msg.
+    """
+    text = json_util.dumps(log_record.get('msg'))
+    keep = len(text)
+    while True:
+        data = encode([dict(log_record, msg=text[:keep], truncated=True)])
+        if len(data) <= size:
+            return data
+        if not keep:
+            return None
+        keep = max(0, keep - (len(data) - size))
+
+
+def is_private(directory):
+    """
+    True if directory is a directory owned by this user that nobody else can use
+    """
+    try:
+        st = os.lstat(directory)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def private_directory(directory):
+    """
+    Create directory so only this user can use it, or check an existing one is like that
+    """
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    if not is_private(directory):
+        raise LogConfigError("%s must be a directory owned by this user that nobody else can use" % directory)
+
+
+def decode(data):
+    return [json_util.loads(line, **_LOADS_OPTIONS) for line in data.decode('utf-8').splitlines() if line]
+
+
+class Collector(object):
+    """
+    Receive log records from CollectorLogHandlers over a unix datagram socket
+    and write them with a single mongolog handler.
+
+    Every worker process on the host sends to the same socket so there is one
+    connection pool per host instead of one per worker.  Records are queued
+    and written in batches of up to batch_size, waiting at most batch_interval
+    seconds for a batch to fill.  The handler's batch writes group each batch by
+    uuid, so a message logged by every worker becomes a single upsert.  When the
+    queue is full the collector stops reading and the clients' sends fail fast
+    instead of blocking.
+
+    The socket is only usable by this user (mode 0600) unless mode says otherwise,
+    e.g. 0o660 for workers running as another user of the same group.
+    """
+    def __init__(self, handler, path=DEFAULT_SOCKET, batch_size=1000, batch_interval=0.5, queue_size=100000, mode=0o600):
+        self.handler = handler
+        self.path = path
+        self.mode = mode
+        self.writer = QueuedWriter(
+            partial(handler.guard, handler.write_log_records),
+            maxsize=queue_size,
+            timeout=handler.flush_timeout,
+            batch_size=batch_size,
+            batch_interval=batch_interval,
+            name='mongolog-collector',
+        )
+
+        # Number of records received and datagrams that couldn't be decoded
+        self.received = 0
+        self.errors = 0
+
+        self.sock = None
+        self.stopped = False
+
+    def bind(self):
+        """
+        Listen on self.path.  A socket file nobody listens on is left over from a crash and is replaced.
+        """
+        if self.path == DEFAULT_SOCKET:
+            private_directory(os.path.dirname(self.path))
+
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.remove(self.path)
+            else:
+                raise LogConfigError("A collector is already listening on %s" % self.path)
+            finally:
+                probe.close()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, self.mode)
+        self.sock.settimeout(0.5)
+
+    def serve(self, duration=None):
+        """
+        Receive records until stop() is called, or for duration seconds
+        """
+        if self.sock is None:
+            self.bind()
+
+        deadline = None if duration is None else time.time() + duration
+        while not self.stopped and (deadline is None or time.time() < deadline):
+            try:
+                data = self.sock.recv(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            self.receive(data)
+
+    def receive(self, data):
+        try:
+            log_records = decode(data)
+        except ValueError:
+            self.errors += 1
+            return
+
+        # Clients don't know the mongo version so they use the strictest key rules.  Redo the
+        # keys and uuids with the handler's so records match the ones it logs directly.
+        mongo_version = self.handler.mongo_version
+        rekey = mongo_version is not None and mongo_version >= 3.6
+        for log_record in log_records:
+            if rekey:
+                self.handler.rekey(log_record)
+            self.writer.put(log_record)
+        self.received += len(log_records)
+
+    def stop(self):
+        self.stopped = True
+
+    def close(self):
+        """
+        Write everything still queued and remove the socket
+        """
+        self.stopped = True
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        self.writer.stop(self.writer.timeout)
@@ -12,3 +12,7 @@ class LogConfigError(ValueError):
 
 class UnsupportedVersionError(ValueError):
     pass
+
+
+class CircuitOpenError(RuntimeError):
+    pass
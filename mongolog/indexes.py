@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+    django-mongolog.  Simple Mongo based logger for Django
+    Copyright (C) 2015 - John Furr
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import OrderedDict
+
+import pymongo
+from bson.son import SON
+
+# Index options that are compared when deciding if an existing index matches the profile
+INDEX_OPTIONS = ('unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds')
+
+
+def index_name(keys):
+    """
+    The name mongo gives an index on keys by default
+    """
+    return '_'.join('%s_%s' % (field, direction) for field, direction in keys)
+
+
+def index(keys, name=None, **options):
+    """
+    An index spec in the same format as Collection.index_information()
+    """
+    spec = dict(options)
+    spec['key'] = [(field, direction) for field, direction in keys]
+    spec['name'] = name or index_name(spec['key'])
+    return spec
+
+
+def minimal_profile(handler):
+    """
+    Only the unique indexes every handler needs to upsert correctly.
+    Capped handlers append, so uuids repeat and there is nothing to index.
+    """
+    profile = {
+        'mongolog': [] if handler.record_type == handler.CAPPED else [index([('uuid', 1)], unique=True)],
+        'timestamp': [],
+    }
+    if handler.record_type == handler.REFERENCE and handler.timestamp_layout == handler.TIMESTAMP_BUCKETS:
+        # Timestamp buckets are upserted too
+        profile['timestamp'].append(index([('uuid', 1), ('hour', 1)], unique=True))
+    return profile
+
+
+def default_profile(handler):
+    """
+    The uuid index plus indexes for the common filters: level, name and
+    the handler's sort key, and a partial index of the errors.
+
+    Every index has its own key pattern.  Mongo < 5.0 won't build two indexes
+    on the same keys, which is also why the sort key's TTL index (see
+    retention_profile) replaces the plain one instead of being added.
+
+    Capped collections get no indexes at all.  Every append would have to
+    update them, and capped records are meant to be the cheapest write.  Give
+    a capped handler an index_profile dict to index it anyway.
+    """
+    profile = minimal_profile(handler)
+    if handler.record_type == handler.CAPPED:
+        return profile
+
+    sort = (handler.sort_key, pymongo.DESCENDING)
+    errors = {handler.LEVEL_FIELD: 'ERROR'}
+    error_keys = [sort, ('name', 1)]
+    profile['mongolog'] += [index(keys) for keys in handler.query_indexes()] + [
+        index([(handler.LEVEL_FIELD, 1), sort]),
+        index([('name', 1), sort]),
+        index(error_keys, name='%s_%s_ERROR' % (index_name(error_keys), handler.LEVEL_FIELD), partialFilterExpression=errors),
+    ]
+
+    if handler.record_type == handler.REFERENCE and handler.timestamp_layout == handler.TIMESTAMP_DOCUMENTS:
+        profile['timestamp'].append(index([('uuid', 1), ('ts', 1)]))
+
+    return profile
+
+
+def retention_profile(handler):
+    """
+    TTL indexes that expire records retention_days after their sort key: when an
+    embedded record was first seen or when a reference record was last seen.
+    Reference handlers also expire their timestamp entries.  Capped collections
+    can't have TTL indexes, they already have a fixed size.
+    """
+    if not handler.retention_days or handler.record_type == handler.CAPPED:
+        return {'mongolog': [], 'timestamp': []}
+
+    seconds = int(handler.retention_days * 24 * 60 * 60)
+    profile = {
+        'mongolog': [index([(handler.sort_key, pymongo.DESCENDING)], expireAfterSeconds=seconds)],
+        'timestamp': [],
+    }
+    if handler.record_type == handler.REFERENCE:
+        # Buckets expire retention_days after the hour they start at
+        field = 'hour' if handler.timestamp_layout == handler.TIMESTAMP_BUCKETS else 'ts'
+        profile['timestamp'].append(index([(field, 1)], expireAfterSeconds=seconds))
+    return profile
+
+
+PROFILES = {
+    'minimal': minimal_profile,
+    'default': default_profile,
+}
+
+
+def get_profile(handler):
+    """
+    Return the handler's index profile as {'mongolog': [specs], 'timestamp': [specs]}
+
+    handler.index_profile is either the name of one of the PROFILES or a
+    dict of the same shape whose specs have a 'key' list and any
+    create_index() options.  The unique uuid index is always included, and
+    so are the TTL indexes when handler.retention_days is set.
+    """
+    profile = handler.index_profile
+    if isinstance(profile, dict):
+        specs = minimal_profile(handler)
+        for collection in ['mongolog', 'timestamp']:
+            for spec in profile.get(collection, []):
+                options = dict((k, v) for k, v in spec.items() if k != 'key')
+                specs[collection].append(index(spec['key'], **options))
+    elif profile in PROFILES:
+        specs = PROFILES[profile](handler)
+    else:
+        raise ValueError("index_profile must be a dict or one of %s" % sorted(PROFILES))
+
+    # A TTL index takes the place of a plain index on the same field
+    for collection, ttls in retention_profile(handler).items():
+        names = set(spec['name'] for spec in ttls)
+        specs[collection] = [spec for spec in specs[collection] if spec['name'] not in names] + ttls
+
+    return specs
+
+
+def collection_profiles(handlers):
+    """
+    Merge the profiles of handlers that write to the same collections.
+
+    Returns an OrderedDict of (connection, database, collection) -> (collection, [specs])
+    so that applying one handler's profile never drops an index another handler needs.
+    """
+    profiles = OrderedDict()
+    for handler in handlers:
+        profile = get_profile(handler)
+        collections = [
+            (handler.collection, handler.get_collection(), profile['mongolog']),
+            (handler.timestamp_name, handler.get_timestamp_collection(), profile['timestamp']),
+        ]
+        for name, collection, wanted in collections:
+            key = (handler.connection, handler.database, name)
+            specs = profiles.setdefault(key, (collection, OrderedDict()))[1]
+            for spec in wanted:
+                if 'expireAfterSeconds' in spec or spec['name'] not in specs:
+                    specs[spec['name']] = spec
+
+    return OrderedDict((key, (collection, list(specs.values()))) for key, (collection, specs) in profiles.items())
+
+
+def _normalized(spec):
+    keys = [(field, int(d) if isinstance(d, float) else d) for field, d in spec['key']]
+    return keys, dict((k, spec.get(k)) for k in INDEX_OPTIONS)
+
+
+def diff_indexes(collection, specs):
+    """
+    Compare the indexes of collection with specs.
+
+    Returns (create, drop) where create is the list of specs to create and
+    drop the list of index names to drop.  An index whose name matches a
+    spec but whose keys or options differ is both dropped and created.
+    """
+    existing = collection.index_information()
+    wanted = OrderedDict((spec['name'], spec) for spec in specs)
+
+    create = []
+    drop = []
+    for name, info in existing.items():
+        if name == '_id_':
+            continue
+        if name not in wanted:
+            drop.append(name)
+        elif _normalized(info) != _normalized(wanted[name]):
+            drop.append(name)
+
+    for name, spec in wanted.items():
+        if name not in existing or name in drop:
+            create.append(spec)
+
+    return create, drop
+
+
+def apply_indexes(collection, specs, drop_unused=True):
+    """
+    Make collection's indexes match specs.  Returns (created, dropped).
+    """
+    update_ttls(collection, specs)
+    create, drop = diff_indexes(collection, specs)
+    if not drop_unused:
+        names = set(spec['name'] for spec in create)
+        drop = [name for name in drop if name in names]
+
+    for name in drop:
+        collection.drop_index(name)
+
+    for spec in create:
+        options = dict((k, v) for k, v in spec.items() if k != 'key')
+        collection.create_index(spec['key'], **options)
+
+    return create, drop
+
+
+def update_ttls(collection, specs):
+    """
+    Change the expireAfterSeconds of existing TTL indexes in place with collMod
+    instead of rebuilding them.  Returns the specs that were updated.
+    """
+    existing = collection.index_information()
+    updated = []
+    for spec in specs:
+        info = existing.get(spec['name'])
+        if not info or 'expireAfterSeconds' not in info or 'expireAfterSeconds' not in spec:
+            continue
+        if _normalized(info)[0] != _normalized(spec)[0] or info['expireAfterSeconds'] == spec['expireAfterSeconds']:
+            continue
+
+        collection.database.command('collMod', collection.name, index={
+            'keyPattern': SON(spec['key']),
+            'expireAfterSeconds': spec['expireAfterSeconds'],
+        })
+        updated.append(spec)
+    return updated
+
+
+def reconcile_ttls(handler):
+    """
+    Create, update or drop the handler's TTL indexes so they match handler.retention_days.
+
+    Only TTL indexes are touched.  Returns a list of (change, collection name, index name)
+    where change is '+' for created, '~' for updated and '-' for dropped.
+    """
+    changes = []
+    wanted = retention_profile(handler)
+    collections = [(handler.get_collection(), wanted['mongolog']), (handler.get_timestamp_collection(), wanted['timestamp'])]
+    if handler.record_type != handler.REFERENCE:
+        # Embedded handlers don't write to the timestamp collection
+        collections.pop()
+
+    for collection, specs in collections:
+        names = set(spec['name'] for spec in specs)
+        for name, info in collection.index_information().items():
+            if 'expireAfterSeconds' in info and name not in names:
+                collection.drop_index(name)
+                changes.append(('-', collection.name, name))
+
+        for spec in update_ttls(collection, specs):
+            changes.append(('~', collection.name, spec['name']))
+
+        for spec in apply_indexes(collection, specs, drop_unused=False)[0]:
+            changes.append(('+', collection.name, spec['name']))
+
+    return changes
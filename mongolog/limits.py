@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    django-mongolog.  Simple Mongo based logger for Django
+    Copyright (C) 2015 - John Furr
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from mongolog.records import fingerprint
+
+
+_string_types = (str, type(u''))
+
+
+class TokenBucket(object):
+    """
+    Allow 'rate' events a second on average and bursts of up to 'burst' events
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RecordLimiter(object):
+    """
+    Decide which python LogRecords are written, before any mongolog record is built.
+
+    Records are keyed by logger name, level, call site and message.  String
+    messages are keyed as they are.  Dicts and lists are keyed by the fingerprint
+    of their str(), so messages with different uuids never share a key.  Each key gets a token
+    bucket allowing 'rate' records a second (or the rate of its level in
+    level_rates) with bursts of 'burst'.  Records of the levels in sample_rates
+    are first kept with that probability.
+
+    check(record) returns the weight of the record: the number of log calls it
+    stands for, or 0 if it should not be written.  A record kept by sampling
+    with probability p weighs 1 / p, randomly rounded to a whole number so the
+    expected total is exact.  The weight of records suppressed by a rate limit
+    is added to the next record of the same key that gets through.  pending()
+    hands back the last suppressed record of the keys still holding weight, so
+    the handler can write them when it is flushed or closed.
+    """
+    def __init__(self, rate=None, burst=None, level_rates=None, sample_rates=None, max_keys=10000, clock=time.time,
+                 rand=random.random):
+        self.rate = rate
+        self.burst = burst
+        self.level_rates = dict((_levelno(level), r) for level, r in (level_rates or {}).items())
+        self.sample_rates = dict((_levelno(level), p) for level, p in (sample_rates or {}).items())
+        self.max_keys = max_keys
+        self.clock = clock
+        self.rand = rand
+
+        # key -> [TokenBucket, suppressed weight, last suppressed record]
+        self.keys = OrderedDict()
+
+        # Records not written because of sampling and of rate limits
+        self.sampled_out = 0
+        self.suppressed = 0
+
+        self._lock = threading.Lock()
+
+    def key(self, record):
+        msg = record.msg
+        if not isinstance(msg, _string_types):
+            # dicts and lists aren't hashable
+            msg = fingerprint(msg, record.levelname)
+        return (record.name, record.levelno, record.pathname, record.lineno, msg)
+
+    def sample(self, levelno):
+        """
+        The weight of a record of level levelno after sampling.  0 if it was sampled out.
+        """
+        p = self.sample_rates.get(levelno)
+        if p is None or p >= 1:
+            return 1
+        if p <= 0 or self.rand() >= p:
+            self.sampled_out += 1
+            return 0
+
+        weight = 1 / float(p)
+        whole = int(weight)
+        return whole + (1 if self.rand() < weight - whole else 0)
+
+    def check(self, record):
+        weight = self.sample(record.levelno)
+        if not weight:
+            return 0
+
+        rate = self.level_rates.get(record.levelno, self.rate)
+        if rate is None:
+            return weight
+
+        now = self.clock()
+        key = self.key(record)
+        with self._lock:
+            entry = self.keys.get(key)
+            if entry is None:
+                entry = self.keys[key] = [TokenBucket(rate, self.burst or max(rate, 1), now), 0, None]
+                if len(self.keys) > self.max_keys:
+                    # The suppressed weight of the least recently seen key is lost
+                    self.keys.popitem(last=False)
+            else:
+                # Most recently seen last
+                self.keys[key] = self.keys.pop(key)
+
+            if not entry[0].take(now):
+                entry[1] += weight
+                entry[2] = record
+                self.suppressed += 1
+                return 0
+
+            weight, entry[1], entry[2] = weight + entry[1], 0, None
+            return weight
+
+    def pending(self):
+        """
+        Return [(record, weight)] of the last suppressed record of every key whose
+        suppressed weight hasn't been carried by a later record yet, and forget it
+        """
+        with self._lock:
+            pending = [(entry[2], entry[1]) for entry in self.keys.values() if entry[1]]
+            for entry in self.keys.values():
+                entry[1], entry[2] = 0, None
+        return pending
+
+    def metrics(self):
+        return {
+            'keys': len(self.keys),
+            'sampled_out': self.sampled_out,
+            'suppressed': self.suppressed,
+        }
+
+
+def _levelno(level):
+    """
+    Level names ('DEBUG') or numbers
+    """
+    if isinstance(level, int):
+        return level
+    levelno = logging.getLevelName(level.upper())
+    if not isinstance(levelno, int):
+        raise ValueError("Unknown logging level %r" % level)
+    return levelno
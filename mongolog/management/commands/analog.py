@@ -4,24 +4,48 @@ from __future__ import print_function
 import logging
 import logging.config
 import json
+import time
 
 import pymongo
+from bson.son import SON
 pymongo_version = int(pymongo.version.split(".")[0])
 if pymongo_version >= 3:
     from pymongo.collection import ReturnDocument  # noqa: F40
 
-from mongolog.models import get_mongolog_handler
+from mongolog.models import Mongolog, get_mongolog_handler
 
 from django.core.management.base import BaseCommand
 
 logger = logging.getLogger('console')
 
+# Fields printed for each log record
+PROJECTION = {'_id': 1, 'level': 1, 'msg': 1}
+
+
+def change_stream_query(query):
+    """
+    Rewrite a find() query so it matches the fullDocument of change stream events
+    """
+    prefixed = {}
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            prefixed[key] = [change_stream_query(q) for q in value]
+        elif key.startswith('$'):
+            prefixed[key] = value
+        else:
+            prefixed['fullDocument.%s' % key] = value
+    return prefixed
+
 
 class Command(BaseCommand):
 
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
         self.prev_object_id = None
+        self.events = 0
+        self.max_events = 0
+        self.deadline = None
+        self.sort_key = 'created'
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -36,6 +60,46 @@ class Command(BaseCommand):
             '-q', '--query', default=None, type=str, action='store', dest='query',
             help='Pass in a search query to mongo.',
         )
+        parser.add_argument(
+            '--max-events', default=0, type=int, action='store', dest='max_events',
+            help='Stop tailing after this many new records.  0 tails forever',
+        )
+        parser.add_argument(
+            '--timeout', default=0, type=float, action='store', dest='timeout',
+            help='Stop tailing after this many seconds.  0 tails forever',
+        )
+        parser.add_argument(
+            '--poll-interval', default=0.1, type=float, action='store', dest='poll_interval',
+            help='Initial seconds between polls when change streams and tailable cursors are unavailable',
+        )
+        parser.add_argument(
+            '--max-poll-interval', default=5, type=float, action='store', dest='max_poll_interval',
+            help='Polls back off exponentially up to this many seconds while nothing new is logged',
+        )
+        parser.add_argument(
+            '--explain', default=False, action='store_true', dest='explain',
+            help='Print the winning query plan and the number of documents examined instead of the results',
+        )
+        parser.add_argument(
+            '--logger', default='simple', type=str, action='store', dest='logger',
+            help='Which mongolog logger to use.  The collection defined in the log handler will be used.',
+        )
+        parser.add_argument(
+            '--uuid', default=None, type=str, action='store', dest='uuid',
+            help='Log record uuid for --history and --histogram',
+        )
+        parser.add_argument(
+            '--history', default=False, action='store_true', dest='history',
+            help='Print every time --uuid was logged.  Reference handlers only',
+        )
+        parser.add_argument(
+            '--histogram', default=False, action='store_true', dest='histogram',
+            help='Print how often --uuid (or every record) was logged per --interval.  Reference handlers only',
+        )
+        parser.add_argument(
+            '--interval', default='hour', choices=['hour', 'minute'], action='store', dest='interval',
+            help='Histogram interval',
+        )
 
     def print_results(self, results):
         # older versions of pymongo didn't use a CommandCursor object to iterate over the results.
@@ -65,30 +129,181 @@ class Command(BaseCommand):
             else:
                 raise Exception("level(%s) not found" % level)
 
-    def fetch_results(self, options):
+    def pipeline(self, options):
         query = options['query'] if options['query'] else {}
-        proj = {'_id': 1, 'level': 1, 'msg': 1}
-        limit = options['limit']
-        return self.collection.aggregate([
+        return [
             {"$match": query},
-            {"$project": proj},
-            {"$sort": {'created': pymongo.DESCENDING}},
-            {"$limit": limit},
-        ])
+            # Sorted and limited before the projection drops the sort key, so an index can serve the sort
+            {"$sort": {self.sort_key: pymongo.DESCENDING}},
+            {"$limit": options['limit']},
+            {"$project": PROJECTION},
+        ]
+
+    def fetch_results(self, options):
+        return self.collection.aggregate(self.pipeline(options))
+
+    def explain(self, options):
+        """
+        Explain the aggregation fetch_results() runs
+        """
+        database = self.collection.database
+        pipeline = self.pipeline(options)
+        try:
+            # mongo >= 3.6
+            plan = database.command(
+                'explain', SON([('aggregate', self.collection.name), ('pipeline', pipeline), ('cursor', {})]),
+                verbosity='executionStats',
+            )
+        except pymongo.errors.OperationFailure:
+            plan = database.command('aggregate', self.collection.name, pipeline=pipeline, explain=True)
+
+        # The query part of the pipeline is explained in its $cursor stage unless the whole pipeline ran as a query
+        plan = plan.get('stages', [{}])[0].get('$cursor', plan)
+
+        # mongo >= 3.0 and the legacy explain format
+        winning_plan = plan.get('queryPlanner', {}).get('winningPlan', plan.get('cursor'))
+        stats = plan.get('executionStats', {})
+        explain = {
+            'sortKey': self.sort_key,
+            'winningPlan': winning_plan,
+            'collectionScan': 'COLLSCAN' in json.dumps(winning_plan, default=str) or winning_plan == 'BasicCursor',
+            'nReturned': stats.get('nReturned', plan.get('n')),
+            'totalKeysExamined': stats.get('totalKeysExamined', plan.get('nscanned')),
+            'totalDocsExamined': stats.get('totalDocsExamined', plan.get('nscannedObjects')),
+        }
+        print(json.dumps(explain, indent=4, sort_keys=True, default=str))
+        return explain
 
     def tail(self, options):
+        """
+        Print the last page of results and then every new record as it arrives.
+
+        Change streams are used when the server supports them (replica sets,
+        mongo >= 3.6).  They also report repeats of embedded records.  Otherwise
+        capped collections are followed with a tailable cursor and anything else
+        is polled for _id's greater than the last one seen.
+        """
         initial = self.fetch_results(options)
         self.print_results(initial)
-        raise NotImplementedError("--tail not finshed")
+
+        self.events = 0
+        self.max_events = options['max_events']
+        self.deadline = time.time() + options['timeout'] if options['timeout'] else None
+        query = options['query'] if options['query'] else {}
+
+        last = list(self.collection.find({}, {'_id': 1}).sort('_id', pymongo.DESCENDING).limit(1))
+        self.prev_object_id = last[0]['_id'] if last else None
+
+        if self.watch(query):
+            return
+
+        if pymongo_version >= 3 and self.collection.options().get('capped'):
+            self.follow(query)
+        else:
+            self.poll(query, options['poll_interval'], options['max_poll_interval'])
+
+    def done(self):
+        if self.max_events and self.events >= self.max_events:
+            return True
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def print_new(self, records):
+        records = [dict((k, r.get(k)) for k in PROJECTION) for r in records]
+        if records:
+            self.events += len(records)
+            self.prev_object_id = records[-1]['_id']
+            self.print_results(records)
+
+    def after(self, query):
+        """
+        query restricted to records newer than the last one printed
+        """
+        if self.prev_object_id is None:
+            return query
+        return {'$and': [query, {'_id': {'$gt': self.prev_object_id}}]}
+
+    def watch(self, query):
+        """
+        Follow a change stream.  Returns False if the server doesn't support them.
+        """
+        if not hasattr(self.collection, 'watch'):
+            return False
+
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]
+        if query:
+            pipeline.append({'$match': change_stream_query(query)})
+
+        try:
+            stream = self.collection.watch(pipeline, full_document='updateLookup', max_await_time_ms=1000)
+        except pymongo.errors.OperationFailure:
+            # Standalone servers and mongo < 3.6
+            return False
+
+        with stream:
+            while not self.done():
+                change = stream.try_next()
+                if change and change.get('fullDocument'):
+                    self.print_new([change['fullDocument']])
+        return True
+
+    def follow(self, query):
+        """
+        Follow a capped collection with a tailable cursor
+        """
+        while not self.done():
+            cursor = self.collection.find(self.after(query), PROJECTION, cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+            cursor = cursor.max_await_time_ms(1000)
+            while cursor.alive and not self.done():
+                self.print_new(list(cursor))
+
+            if not self.done():
+                # The cursor died, most likely because the collection was empty
+                time.sleep(1)
+
+    def poll(self, query, interval, max_interval):
+        """
+        Poll for records with an _id greater than the last one seen.  The delay
+        between polls doubles, up to max_interval, while nothing new is found.
+        Note that repeats of an existing embedded record don't change its _id.
+        """
+        delay = interval
+        while not self.done():
+            records = list(self.collection.find(self.after(query), PROJECTION).sort('_id', pymongo.ASCENDING))
+            if records:
+                self.print_new(records)
+                delay = interval
+                continue
+
+            if self.deadline is not None:
+                delay = min(delay, max(0, self.deadline - time.time()))
+            time.sleep(delay)
+            delay = min(delay * 2, max_interval)
+
+    def print_history(self, options):
+        for ts in Mongolog.history(options['uuid'], logger=options['logger']):
+            print(ts)
+
+    def print_histogram(self, options):
+        histogram = Mongolog.histogram(uuid=options['uuid'], logger=options['logger'], interval=options['interval'])
+        width = max([count for ts, count in histogram] + [1])
+        for ts, count in histogram:
+            print("%s %8d %s" % (ts, count, '#' * int(round(50.0 * count / width))))
 
     def handle(self, *args, **options):
         if options['query']:
             options['query'] = json.loads(options['query'])
 
-        handler = get_mongolog_handler('simple')
+        handler = get_mongolog_handler(options['logger'])
         self.collection = handler.get_collection()
+        self.sort_key = handler.sort_key
 
-        if options['tail']:
+        if options['history']:
+            self.print_history(options)
+        elif options['histogram']:
+            self.print_histogram(options)
+        elif options['explain']:
+            self.explain(options)
+        elif options['tail']:
             self.tail(options)
         else:
             results = self.fetch_results(options)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Management command running the host local log collector.
+
+Worker processes log with mongolog.CollectorLogHandler, which sends each record
+to the collector's unix socket.  The collector writes them in batches with the
+mongolog handler of --logger, so there is a single mongo connection pool per host.
+
+Usage Examples:
+
+# Collect on the default socket and write with the 'simple' logger's handler
+./manage.py ml_collector
+
+# Bigger batches, on another socket that workers running as other users of the collector's group can use
+./manage.py ml_collector -s /run/mongolog/mongolog.sock --mode 660 -l mongolog --batch-size 5000 --batch-interval 1
+"""
+from __future__ import print_function
+import logging
+import signal
+
+from mongolog.collector import DEFAULT_SOCKET, Collector
+from mongolog.exceptions import LogConfigError
+from mongolog.models import get_mongolog_handler
+
+from django.core.management.base import BaseCommand
+
+console = logging.getLogger('mongolog-int')
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-s', '--socket', default=DEFAULT_SOCKET, type=str, action='store', dest='socket',
+            help='Unix socket to listen on.  Default: %s' % DEFAULT_SOCKET,
+        )
+        parser.add_argument(
+            '-l', '--logger', default='simple', type=str, action='store', dest='logger',
+            help='Write with the mongolog handler of this logger.  Default: simple',
+        )
+        parser.add_argument(
+            '--batch-size', default=1000, type=int, action='store', dest='batch_size',
+            help='Max number of records in a bulk write.  Default: 1000',
+        )
+        parser.add_argument(
+            '--batch-interval', default=0.5, type=float, action='store', dest='batch_interval',
+            help='Seconds to wait for a batch to fill.  Default: 0.5',
+        )
+        parser.add_argument(
+            '--queue-size', default=100000, type=int, action='store', dest='queue_size',
+            help='Records waiting to be written before the collector stops reading.  Default: 100000',
+        )
+        parser.add_argument(
+            '--mode', default='600', type=str, action='store', dest='mode',
+            help='Permissions of the socket, in octal.  660 lets workers of the same group log.  Default: 600',
+        )
+        parser.add_argument(
+            '--duration', default=None, type=float, action='store', dest='duration',
+            help='Stop after this many seconds.  By default run until interrupted',
+        )
+
+    def handle(self, *args, **options):
+        """ Main processing handle """
+        handler = get_mongolog_handler(logger_name=options['logger'])
+        if getattr(handler, 'mongolog', None) is None:
+            raise LogConfigError("The collector needs a handler that writes to mongo.  %s doesn't" % handler)
+
+        collector = Collector(
+            handler,
+            path=options['socket'],
+            batch_size=options['batch_size'],
+            batch_interval=options['batch_interval'],
+            queue_size=options['queue_size'],
+            mode=int(options['mode'], 8),
+        )
+        collector.bind()
+        signal.signal(signal.SIGTERM, lambda signum, frame: collector.stop())
+
+        print("Collecting on %s for %s" % (collector.path, handler))
+        try:
+            collector.serve(options['duration'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            collector.close()
+
+        print("Received %s records (%s undecodable datagrams)" % (collector.received, collector.errors))
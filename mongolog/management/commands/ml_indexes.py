@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Management command to bring the mongolog indexes in line with the handlers' index profiles.
+
+Usage Examples:
+
+# Show the indexes that would be created and dropped
+./manage.py ml_indexes --diff
+
+# Create the missing indexes
+./manage.py ml_indexes --apply
+
+# Also drop the indexes no profile uses.  Only the handlers configured in this
+# process are known, so check --diff --drop first when other processes log to
+# the same collections with other profiles.
+./manage.py ml_indexes --apply --drop
+"""
+from __future__ import print_function
+import json
+import logging
+
+from mongolog import models
+from mongolog.indexes import apply_indexes, collection_profiles, diff_indexes
+from mongolog.models import get_mongolog_handler
+
+from django.core.management.base import BaseCommand
+
+console = logging.getLogger('mongolog-int')
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-a', '--apply', default=False, action='store_true', dest='apply',
+            help='Create missing indexes',
+        )
+        parser.add_argument(
+            '--diff', default=False, action='store_true', dest='diff',
+            help='Only print the changes --apply would make.  This is the default',
+        )
+        parser.add_argument(
+            '--drop', default=False, action='store_true', dest='drop',
+            help='Also drop the indexes no profile of a handler configured in this process uses',
+        )
+        parser.add_argument(
+            '-l', '--logger', default=None, type=str, action='store', dest='logger',
+            help='Only the collections of this logger\'s mongolog handler.  By default every mongolog handler',
+        )
+
+    def profiles(self, logger_name):
+        """
+        The merged profile of every collection a mongolog handler writes to, or only
+        the collections of logger_name's handler.  Every handler writing to a
+        collection contributes to its profile.
+        """
+        handlers = [h for h in list(models._handlers) if getattr(h, 'mongolog', None) is not None]
+        profiles = collection_profiles(handlers)
+        if not logger_name:
+            return profiles
+
+        handler = get_mongolog_handler(logger_name=logger_name)
+        keys = [(handler.connection, handler.database, name) for name in [handler.collection, handler.timestamp_name]]
+        return dict((key, profiles[key]) for key in keys if key in profiles)
+
+    def handle(self, *args, **options):
+        """ Main processing handle """
+        profiles = self.profiles(options['logger'])
+        for (connection, database, name), (collection, specs) in sorted(profiles.items(), key=lambda item: item[0]):
+            if options['apply'] and not options['diff']:
+                create, drop = apply_indexes(collection, specs, drop_unused=options['drop'])
+            else:
+                create, drop = diff_indexes(collection, specs)
+                if not options['drop']:
+                    names = set(spec['name'] for spec in create)
+                    drop = [index for index in drop if index in names]
+
+            for index in drop:
+                print("- %s.%s %s" % (database, name, index))
+            for spec in create:
+                print("+ %s.%s %s" % (database, name, json.dumps(spec, sort_keys=True, default=str)))
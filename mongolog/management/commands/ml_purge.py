@@ -4,19 +4,33 @@ Management command to handle deletion of previous mongolog records.
 
 Usage Examples:
 
-# Delete all records alder than 54 day's AFTER backing up the current collection 'bulkupload'
- ./manage.py ml_purge -d 54 -b -c bulkupload
+# Delete all records alder than 54 day's, writing each one to ./mongolog.mongolog-<time>.ndjson.gz before it is deleted
+ ./manage.py ml_purge -d 54 -b
 
  # Delete all entries
 ./manage.py ml_purge -p -c bulkupload
+
+# Delete in batches of 1000, at most 5000 documents a second, then remove timestamps of deleted records.
+# If interrupted run it again with --resume to carry on where it left off.
+./manage.py ml_purge -d 54 --batch-size 1000 --max-rate 5000 --orphans
+
+# Only remove the timestamps of deleted records
+./manage.py ml_purge --orphans
+
+# Let mongo expire old records instead.  Reconciles the TTL indexes with the handler's retention_days
+./manage.py ml_purge --ttl
 """
 from __future__ import print_function
 import sys
 import logging
+import time
 from datetime import timedelta
-import subprocess
-from pymongo import MongoClient
 
+import pymongo
+
+from mongolog import models
+from mongolog.backup import FORMATS, NDJSON, BackupWriter, backup_path, path_format
+from mongolog.indexes import reconcile_ttls
 from mongolog.models import get_mongolog_handler
 
 from django.utils import timezone
@@ -24,6 +38,12 @@ from django.core.management.base import BaseCommand
 
 console = logging.getLogger('mongolog-int')
 
+# Collection holding the progress of interrupted batched deletes
+STATE_COLLECTION = 'mongolog_purge'
+
+# --delete when it isn't given
+DEFAULT_DAYS = 14
+
 
 class Command(BaseCommand):
 
@@ -33,8 +53,8 @@ class Command(BaseCommand):
             help='Remove all old results',
         )
         parser.add_argument(
-            '-d', '--delete', default=14, type=int, action='store', dest='delete',
-            help='Delete documents more than -d={n} days old',
+            '-d', '--delete', default=None, type=int, action='store', dest='delete',
+            help='Delete documents more than -d={n} days old.  %s unless --orphans is given on its own' % DEFAULT_DAYS,
         )
         parser.add_argument(
             '-f', '--force', default=False, action='store_true', dest='force',
@@ -42,12 +62,45 @@ class Command(BaseCommand):
         )
         parser.add_argument(
             '-b', '--backup', default=False, action='store_true', dest='backup',
-            help='Backup collection before deleting',
+            help='Write the documents being deleted to a gzip compressed backup file before deleting them',
+        )
+        parser.add_argument(
+            '--backup-dir', default='.', type=str, action='store', dest='backup_dir',
+            help='Directory the backup files are written to',
+        )
+        parser.add_argument(
+            '--backup-format', default=NDJSON, choices=FORMATS, action='store', dest='backup_format',
+            help='ndjson (mongo extended json, one document a line) or bson (readable by mongorestore once gunzip\'ed)',
         )
         parser.add_argument(
             '-l', '--logger', default='mongolog', type=str, action='store', dest='logger',
             help='Which mongolog logger to use.  The collection defined in the log handler will be used.',
         )
+        parser.add_argument(
+            '--ttl', default=False, action='store_true', dest='ttl',
+            help="Create, update or drop the TTL indexes to match the handler's retention_days instead of deleting",
+        )
+        parser.add_argument(
+            '--batch-size', default=0, type=int, action='store', dest='batch_size',
+            help='Delete in batches of this many documents instead of one delete_many.  --backup defaults it to 1000',
+        )
+        parser.add_argument(
+            '--sleep', default=0, type=float, action='store', dest='sleep',
+            help='Seconds to sleep between batches',
+        )
+        parser.add_argument(
+            '--max-rate', default=0, type=float, action='store', dest='max_rate',
+            help='Delete at most this many documents a second',
+        )
+        parser.add_argument(
+            '--resume', default=False, action='store_true', dest='resume',
+            help='Carry on with an interrupted batched delete using its saved cutoff and progress',
+        )
+        parser.add_argument(
+            '--orphans', default=False, action='store_true', dest='orphans',
+            help='Also delete timestamp entries whose uuid is no longer in any mongolog collection.  '
+                 'On its own (without --delete, --purge or --resume) nothing else is deleted',
+        )
 
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
@@ -74,44 +127,205 @@ class Command(BaseCommand):
 
         if self.confirm(**options):
             total = self.collection.find({}).count()
-            self.collection.delete_many({})
             console.warn("Total docs to remove: %s", total)
+            if options['batch_size']:
+                self.delete_in_batches(None, total, **options)
+            else:
+                self.collection.delete_many({})
 
     def delete(self, **options):
         """ Delete all records older than --delete={n} """
         days = options['delete']
-        console.warn("Looking for documents older than %s day's", days)
+        cutoff = timezone.now() - timedelta(days=days)
 
-        query = {
-            'created': {
-                '$lte': timezone.now() - timedelta(days=days)
-            }
-        }
+        state = self.load_state() if options['resume'] else None
+        if state:
+            cutoff = state['cutoff']
+            console.warn("Resuming the delete of documents older than %s", cutoff)
+        else:
+            console.warn("Looking for documents older than %s day's", days)
 
-        total = self.collection.find(query).count()
+        total = self.collection.find(self.query(cutoff)).count()
         console.warn("Total docs to remove: %s", total)
 
         if self.confirm(**options):
-            self.collection.delete_many(query)
+            if options['batch_size']:
+                self.delete_in_batches(cutoff, total, state=state, **options)
+            else:
+                self.collection.delete_many(self.query(cutoff))
             console.info("Total docs removed: %s", total)
 
-    def backup(self):
-        """ Backup the collection before deleting """
-        console.info("Backing up your documents...")
-        cmd = 'mongodump --db mongolog'
-        subprocess.check_call([cmd], shell=True)
+    def query(self, cutoff):
+        """ Documents older than cutoff.  Every document when cutoff is None """
+        if cutoff is None:
+            return {}
+        return {self.handler.sort_key: {'$lte': cutoff}}
+
+    def load_state(self):
+        return self.state.find_one({'_id': self.collection.full_name})
+
+    def delete_in_batches(self, cutoff, total, state=None, **options):
+        """
+        Delete the documents matching query(cutoff) batch_size at a time, oldest first.
+
+        Each batch is found through the sort key index (_id when purging everything)
+        and deleted by _id.  The progress is saved after every batch so --resume can
+        pick up after an interruption.
+        """
+        query = self.query(cutoff)
+        order = self.handler.sort_key if cutoff is not None else '_id'
+        state = state or {'_id': self.collection.full_name, 'cutoff': cutoff, 'watermark': None, 'deleted': 0, 'backup': None}
+
+        backup = None
+        if options['backup']:
+            # A resumed delete appends to the backup it started
+            state['backup'] = state.get('backup') or backup_path(options['backup_dir'], self.collection, options['backup_format'])
+            backup = BackupWriter(state['backup'], path_format(state['backup']))
+            console.info("Backing up deleted documents to %s", state['backup'])
+
+        start = time.time()
+        deleted = 0
+        while True:
+            batch = self.next_batch(query, order, state['watermark'], backup is None, options['batch_size'])
+            if not batch:
+                break
+
+            # Written before it's deleted.  A batch interrupted in between is written again when resumed.
+            if backup:
+                backup.write(batch)
+
+            # query is checked again in case a reference record was logged again since it was found
+            result = self.collection.delete_many({'$and': [query, {'_id': {'$in': [doc['_id'] for doc in batch]}}]})
+            deleted += result.deleted_count
+            state['deleted'] += result.deleted_count
+            state['watermark'] = batch[-1].get(order)
+            self.state.replace_one({'_id': state['_id']}, state, upsert=True)
+
+            elapsed = time.time() - start
+            console.info("Deleted %s of %s (%.0f docs/sec)", state['deleted'], total, deleted / elapsed if elapsed else 0)
+            self.throttle(start, deleted, **options)
+
+        self.state.delete_one({'_id': state['_id']})
+        return state['deleted']
+
+    def next_batch(self, query, order, watermark, ids_only, size):
+        """ The oldest size documents matching query, starting at watermark """
+        if watermark is not None:
+            query = {'$and': [query, {order: {'$gte': watermark}}]}
+        projection = {order: 1} if ids_only else None
+        return list(self.collection.find(query, projection).sort(order, pymongo.ASCENDING).limit(size))
+
+    def throttle(self, start, done, **options):
+        """ Sleep --sleep seconds and long enough to keep under --max-rate """
+        delay = options['sleep']
+        if options['max_rate']:
+            delay = max(delay, start + done / float(options['max_rate']) - time.time())
+        if delay > 0:
+            time.sleep(delay)
+
+    def purge_orphans(self, **options):
+        """
+        Delete timestamp entries whose uuid isn't in any mongolog collection of this database
+        """
+        timestamp = self.handler.get_timestamp_collection()
+        collections = [self.handler.get_db()[name] for name in self.collection_names()]
+        batch_size = options['batch_size'] or 1000
+
+        backup = None
+        if options['backup']:
+            backup = BackupWriter(backup_path(options['backup_dir'], timestamp, options['backup_format']), options['backup_format'])
+            console.info("Backing up orphaned timestamps to %s", backup.path)
+
+        start = time.time()
+        deleted = 0
+        uuids = timestamp.aggregate([{'$group': {'_id': '$uuid'}}], allowDiskUse=True, batchSize=batch_size)
+        for chunk in chunks((doc['_id'] for doc in uuids), batch_size):
+            found = set()
+            for collection in collections:
+                found.update(doc['uuid'] for doc in collection.find({'uuid': {'$in': chunk}}, {'uuid': 1}))
+
+            orphans = [uuid for uuid in chunk if uuid not in found]
+            if orphans and backup:
+                for documents in chunks(timestamp.find({'uuid': {'$in': orphans}}), batch_size):
+                    backup.write(documents)
+            if orphans:
+                deleted += timestamp.delete_many({'uuid': {'$in': orphans}}).deleted_count
+                self.throttle(start, deleted, **options)
+
+        console.info("Orphaned timestamps removed: %s", deleted)
+        return deleted
+
+    def collection_names(self):
+        """
+        Collections of this handler's database that mongolog records may be in: the ones written
+        by the mongolog handlers of this process and every collection with a uuid index.  Handlers
+        configured in other processes or settings share the timestamp collection, and every
+        non capped handler creates a uuid index on its collection.
+        """
+        database = (self.handler.connection, self.handler.database)
+        names = set([self.handler.collection])
+        for handler in list(models._handlers):
+            if getattr(handler, 'mongolog', None) is not None and (handler.connection, handler.database) == database:
+                names.add(handler.collection)
+
+        db = self.handler.get_db()
+        existing = db.list_collection_names() if pymongo.version_tuple >= (3, 7) else db.collection_names()
+        for name in existing:
+            if name not in names and any(info['key'] == [('uuid', 1)] for info in db[name].index_information().values()):
+                names.add(name)
+        return sorted(names)
+
+    def ttl(self, handler):
+        """ Reconcile the TTL indexes with handler.retention_days """
+        if handler.retention_days:
+            console.info("Expiring documents %s day's old", handler.retention_days)
+        else:
+            console.info("retention_days is not set.  Removing TTL indexes")
+
+        changes = reconcile_ttls(handler)
+        for change, collection, name in changes:
+            console.info("%s %s.%s", change, collection, name)
+        if not changes:
+            console.info("TTL indexes are up to date")
+        return changes
 
     def handle(self, *args, **options):
         """ Main processing handle """
         handler = get_mongolog_handler(logger_name=options['logger'])
-        client = MongoClient(handler.connection)
-        db = client.mongolog
-        self.collection = getattr(db, handler.collection)
+        self.handler = handler
+        self.collection = handler.get_collection()
+        self.state = handler.get_db()[STATE_COLLECTION]
 
-        if options['backup']:
-            self.backup()
+        if options['ttl']:
+            self.ttl(handler)
+            return
+
+        if handler.record_type == handler.CAPPED:
+            console.error("%s is a capped collection.  Mongo removes the oldest documents itself", self.collection.full_name)
+            return
+
+        if options['backup'] and not options['batch_size']:
+            # The backup is written batch by batch as the documents are deleted
+            options['batch_size'] = 1000
 
         if options['purge']:
             self.purge(**options)
-        elif isinstance(options['delete'], int):
+        elif options['delete'] is not None or options['resume'] or not options['orphans']:
+            if options['delete'] is None:
+                options['delete'] = DEFAULT_DAYS
             self.delete(**options)
+
+        if options['orphans']:
+            self.purge_orphans(**options)
+
+
+def chunks(iterable, size):
+    """ Yield lists of up to size items from iterable """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Management command to inspect and replay the local spool of handlers with a spool_dir.
+
+Usage Examples:
+
+# Show the spool segments of every handler and how many records are waiting in each
+./manage.py ml_spool status
+
+# Write the spooled records of the 'simple' logger's handler to mongo
+./manage.py ml_spool replay -l simple
+"""
+from __future__ import print_function
+import logging
+
+from mongolog import models
+from mongolog.models import get_mongolog_handler
+
+from django.core.management.base import BaseCommand
+
+console = logging.getLogger('mongolog-int')
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'action', choices=['status', 'replay'],
+            help='status lists the spool segments.  replay writes the spooled records and removes the segments',
+        )
+        parser.add_argument(
+            '-l', '--logger', default=None, type=str, action='store', dest='logger',
+            help='Only the spool of this logger\'s mongolog handler.  By default every handler with a spool_dir',
+        )
+
+    def handlers(self, logger_name):
+        if logger_name:
+            handlers = [get_mongolog_handler(logger_name=logger_name)]
+        else:
+            handlers = list(models._handlers)
+        return [handler for handler in handlers if getattr(handler, 'spool', None) is not None]
+
+    def handle(self, *args, **options):
+        """ Main processing handle """
+        handlers = self.handlers(options['logger'])
+        if not handlers:
+            print("No handler has a spool_dir")
+            return
+
+        for handler in handlers:
+            spool = handler.spool
+            if options['action'] == 'replay':
+                count = handler.replay_spool()
+                print("%s: replayed %s records" % (spool.name, count))
+
+            for path, state, size, records in spool.status():
+                print("%s %s %s bytes %s records" % (path, state, size, records))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Management command to print the metrics of mongolog handlers.
+
+Metrics live in the process that logs.  Handlers with a metrics_file write
+theirs to that file every metrics_interval seconds, and --files adds them up.
+
+Usage Examples:
+
+# Metrics of the 'simple' logger's handler in this process
+./manage.py ml_stats --handler simple
+
+# Add up the files every worker wrote and print them for Prometheus
+./manage.py ml_stats --files '/tmp/mongolog-*.json' --prometheus
+"""
+from __future__ import print_function
+import glob
+import json
+import logging
+
+from mongolog import models
+from mongolog.metrics import merge, prometheus
+from mongolog.models import get_mongolog_handler
+
+from django.core.management.base import BaseCommand
+
+console = logging.getLogger('mongolog-int')
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-l', '--handler', default=None, type=str, action='store', dest='handler',
+            help='Only the mongolog handler of this logger.  By default every handler in this process',
+        )
+        parser.add_argument(
+            '-f', '--files', default=None, type=str, action='store', dest='files',
+            help='Read and add up the metrics files matching this glob instead',
+        )
+        parser.add_argument(
+            '-p', '--prometheus', default=False, action='store_true', dest='prometheus',
+            help='Print the Prometheus text format instead of json',
+        )
+
+    def snapshots(self, options):
+        if options['files']:
+            snapshots = []
+            for path in sorted(glob.glob(options['files'])):
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            return merge(snapshots)
+
+        if options['handler']:
+            handlers = [get_mongolog_handler(logger_name=options['handler'])]
+        else:
+            handlers = list(models._handlers)
+        return [handler.stats() for handler in handlers]
+
+    def handle(self, *args, **options):
+        """ Main processing handle """
+        snapshots = self.snapshots(options)
+        if options['prometheus']:
+            print(prometheus(snapshots), end='')
+        else:
+            print(json.dumps(snapshots, indent=4, sort_keys=True))
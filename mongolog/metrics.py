@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+    django-mongolog.  Simple Mongo based logger for Django
+    Copyright (C) 2015 - John Furr
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+# Highest resolution clock available.  time.perf_counter is python 3 only.
+clock = getattr(time, 'perf_counter', time.time)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'),
+)
+
+
+class Histogram(object):
+    """
+    Counts of observed values in fixed buckets, plus their sum
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        The upper bound of the bucket holding the q quantile
+        """
+        return quantile(self.buckets, self.counts, q)
+
+    def snapshot(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+def quantile(buckets, counts, q):
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(buckets, counts):
+        seen += count
+        if seen >= q * total:
+            return bound
+    return buckets[-1]
+
+
+class HandlerMetrics(object):
+    """
+    Counters and per stage latency histograms of a handler.
+
+    Stages are 'emit' (the whole emit() call), 'build' (create_log_record),
+    'sanitize' (check_keys), 'uuid' (fingerprinting the message) and 'write'
+    (one write to mongo, the collector or the HTTP collector).  Failed writes are
+    timed in 'write_failed'.  Counters are updated without a lock, so under
+    heavy contention a count can be off by a few.
+
+    When path is set the handler's stats() are written to it as json every
+    'interval' seconds.  '{pid}' in path is replaced by the process id.
+    """
+    def __init__(self, path=None, interval=10):
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self.path = path
+        self.interval = interval
+        self.next_dump = None if path is None else time.time() + interval
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, stage, seconds):
+        # Histogram.observe() inlined.  This runs several times per emit.
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.counts[bisect_left(histogram.buckets, seconds)] += 1
+        histogram.sum += seconds
+
+    def due(self):
+        """
+        True if it is time to write the stats to self.path
+        """
+        return self.next_dump is not None and time.time() >= self.next_dump
+
+    def dump(self, stats):
+        self.next_dump = time.time() + self.interval
+        path = self.path.format(pid=os.getpid())
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            json.dump(stats, f, sort_keys=True)
+        os.rename(tmp, path)
+
+    def snapshot(self, handler, counters=None, gauges=None):
+        """
+        Return the counters, gauges and histograms as a dict.  counters and
+        gauges are added to the handler's own, e.g. the queue depth.
+        """
+        histograms = {}
+        for stage, histogram in list(self.histograms.items()):
+            histograms[stage] = histogram.snapshot()
+            histograms[stage]['p50'] = histogram.quantile(0.5)
+            histograms[stage]['p99'] = histogram.quantile(0.99)
+
+        # The number of emits and successful writes are the counts of their histograms
+        all_counters = dict(self.counters)
+        all_counters.update(counters or {})
+        for stage, counter in [('emit', 'emitted'), ('write', 'writes')]:
+            if stage in histograms:
+                all_counters[counter] = histograms[stage]['count']
+
+        return {
+            'handler': handler,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'counters': all_counters,
+            'gauges': dict(gauges or {}),
+            'histograms': histograms,
+        }
+
+
+class NullMetrics(HandlerMetrics):
+    """
+    Used when a handler's metrics are turned off
+    """
+    def inc(self, name, value=1):
+        pass
+
+    def observe(self, stage, seconds):
+        pass
+
+    def due(self):
+        return False
+
+
+def merge(snapshots):
+    """
+    Add up the snapshots of several processes.  Returns one snapshot per handler.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        total = merged.setdefault(snapshot['handler'], {
+            'handler': snapshot['handler'], 'processes': 0, 'counters': {}, 'gauges': {}, 'histograms': {},
+        })
+        total['processes'] += 1
+        for kind in ['counters', 'gauges']:
+            for name, value in snapshot[kind].items():
+                total[kind][name] = total[kind].get(name, 0) + value
+
+        for stage, histogram in snapshot['histograms'].items():
+            into = total['histograms'].setdefault(
+                stage, {'buckets': histogram['buckets'], 'counts': [0] * len(histogram['counts']), 'sum': 0, 'count': 0},
+            )
+            into['counts'] = [a + b for a, b in zip(into['counts'], histogram['counts'])]
+            into['sum'] += histogram['sum']
+            into['count'] += histogram['count']
+
+    for total in merged.values():
+        for histogram in total['histograms'].values():
+            histogram['p50'] = quantile(histogram['buckets'], histogram['counts'], 0.5)
+            histogram['p99'] = quantile(histogram['buckets'], histogram['counts'], 0.99)
+    return list(merged.values())
+
+
+def prometheus(snapshots):
+    """
+    Render snapshots in the Prometheus text exposition format
+    """
+    families = {}
+
+    def add(family, kind, line):
+        families.setdefault(family, (kind, []))[1].append(line)
+
+    for snapshot in snapshots:
+        label = 'handler="%s"' % snapshot['handler'].replace('\\', '\\\\').replace('"', '\\"')
+        for name, value in snapshot['counters'].items():
+            add('mongolog_%s_total' % name, 'counter', 'mongolog_%s_total{%s} %s' % (name, label, value))
+        for name, value in snapshot['gauges'].items():
+            add('mongolog_%s' % name, 'gauge', 'mongolog_%s{%s} %s' % (name, label, value))
+        for stage, histogram in snapshot['histograms'].items():
+            family = 'mongolog_%s_seconds' % stage
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                add(family, 'histogram', '%s_bucket{%s,le="%s"} %s' % (family, label, le, cumulative))
+            add(family, 'histogram', '%s_sum{%s} %s' % (family, label, histogram['sum']))
+            add(family, 'histogram', '%s_count{%s} %s' % (family, label, histogram['count']))
+
+    lines = []
+    for family in sorted(families):
+        kind, samples = families[family]
+        lines.append('# TYPE %s %s' % (family, kind))
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
@@ -17,22 +17,68 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import json
+from collections import defaultdict
+from datetime import datetime, timedelta
 import pymongo
-from pymongo import MongoClient
 pymongo_version = int(pymongo.version.split(".")[0])
 if pymongo_version >= 3:
     from pymongo.collection import ReturnDocument  # noqa: F401
 
 from mongolog.exceptions import LogConfigError
+from mongolog.records import bucket_hour
 import logging
+import weakref
 console = logging.getLogger('mongolog-int')
 
 
+# Every live mongolog handler.  Handlers add themselves when they are created
+# and remove themselves when they are closed (dictConfig closes the old ones).
+_handlers = weakref.WeakSet()
+
+# logger_name -> (name of the logger the handler is attached to, handler)
+_handler_cache = {}
+
+
+def register_handler(handler):
+    """
+    Called by BaseMongoLogHandler.__init__.  A new handler can change what get_mongolog_handler() finds.
+    """
+    _handlers.add(handler)
+    _handler_cache.clear()
+
+
+def unregister_handler(handler):
+    """
+    Called by BaseMongoLogHandler.close()
+    """
+    _handlers.discard(handler)
+    _handler_cache.clear()
+
+
+def _cached_handler(logger_name):
+    """
+    Return the handler cached for logger_name if it is still attached to its logger
+    """
+    cached = _handler_cache.get(logger_name)
+    if cached is not None:
+        name, handler = cached
+        if handler in logging.getLogger(name).handlers:
+            return handler
+    return None
+
+
 def get_mongolog_handler(logger_name=None, show_logger_names=False):
     """
     Return the first MongoLogHander found in the list of defined loggers.
     NOTE: If more than one is defined, only the first one is used.
+
+    Lookups are cached until a mongolog handler is created or closed, or the
+    cached handler is removed from its logger.
     """
+    handler = _cached_handler(logger_name)
+    if handler and not show_logger_names:
+        return handler
+
     from mongolog.handlers import BaseMongoLogHandler
     if logger_name:
         logger_names = [logger_name]
@@ -58,6 +104,8 @@ def get_mongolog_handler(logger_name=None, show_logger_names=False):
             raise LogConfigError("logger '%s' does not have a mongolog based handler associated with it." % logger_name)
 
         raise LogConfigError("There are no loggers with a mongolog based handler.  Please see documentation about setting up LOGGING.")
+
+    _handler_cache[logger_name] = (name, handler)
     return handler
 
 
@@ -73,16 +121,15 @@ class Mongolog(object):
         """
          return self.collection.aggregate([
             {"$match": query},
-            {"$project": proj},
             {"$sort": {'created': pymongo.DESCENDING}},
             {"$limit": limit},
+            {"$project": proj},
         ])
         """
         logger = cls.LOGGER if cls.LOGGER else logger
 
         handler = get_mongolog_handler(logger_name=logger)
-        client = MongoClient(handler.connection)
-        db = client.mongolog
+        db = handler.get_client()[handler.database]
 
         if logger:
             collection = getattr(db, handler.collection)
@@ -98,24 +145,111 @@ class Mongolog(object):
             query.update({'uuid': uuid})
 
         if level:
-            query.update({'level': level})
+            query.update({handler.LEVEL_FIELD: level})
 
         if logger:
             query.update({'name': logger})
 
         aggregate_commands.append({"$match": query})
 
-        if project:
-            aggregate_commands.append({"$project": project})
-
-        aggregate_commands.append({"$sort": {'created': pymongo.DESCENDING}})
+        # Sort and limit before the projection can drop the sort key
+        aggregate_commands.append({"$sort": {handler.sort_key: pymongo.DESCENDING}})
 
         if limit:
             aggregate_commands.append({"$limit": limit})
 
+        if project:
+            aggregate_commands.append({"$project": project})
+
         results = collection.aggregate(aggregate_commands)
         return results['result'] if isinstance(results, dict) else results
 
+    @classmethod
+    def timestamp_handler(cls, logger=None):
+        handler = get_mongolog_handler(logger_name=logger or cls.LOGGER)
+        if handler.record_type != handler.REFERENCE:
+            raise LogConfigError("Only reference handlers keep a timestamp collection")
+        return handler
+
+    @classmethod
+    def history(cls, uuid, logger=None, start=None, end=None):
+        """
+        Return the times the record uuid was logged between start and end, oldest first.
+        With the 'buckets' timestamp_layout only the last bucket_keep times of each hour are kept.
+        """
+        handler = cls.timestamp_handler(logger)
+        timestamp = handler.get_timestamp_collection()
+
+        if handler.timestamp_layout == handler.TIMESTAMP_DOCUMENTS:
+            query = dict(_time_range('ts', start, end), uuid=uuid)
+            return [doc['ts'] for doc in timestamp.find(query, {'ts': 1}).sort('ts', pymongo.ASCENDING)]
+
+        query = dict(_time_range('hour', start and bucket_hour(start), end), uuid=uuid)
+        times = []
+        for bucket in timestamp.find(query, {'times': 1}).sort('hour', pymongo.ASCENDING):
+            times.extend(ts for ts in bucket['times'] if (not start or ts >= start) and (not end or ts <= end))
+        return times
+
+    @classmethod
+    def histogram(cls, uuid=None, logger=None, start=None, end=None, interval='hour'):
+        """
+        Return [(datetime, count)] of how often uuid (or every record) was logged per
+        'hour' or 'minute' between start and end.  The 'buckets' timestamp_layout
+        counts per minute, so start and end are rounded down to their minute there.
+        """
+        if interval not in ['hour', 'minute']:
+            raise ValueError("interval must be 'hour' or 'minute'")
+
+        handler = cls.timestamp_handler(logger)
+        timestamp = handler.get_timestamp_collection()
+        counts = defaultdict(int)
+
+        if handler.timestamp_layout == handler.TIMESTAMP_DOCUMENTS:
+            query = _time_range('ts', start, end)
+            if uuid:
+                query['uuid'] = uuid
+
+            parts = ['year', 'month', 'dayOfMonth', 'hour'] + (['minute'] if interval == 'minute' else [])
+            results = timestamp.aggregate([
+                {'$match': query},
+                {'$group': {'_id': dict((part, {'$%s' % part: '$ts'}) for part in parts), 'count': {'$sum': 1}}},
+            ])
+            results = results['result'] if isinstance(results, dict) else results
+            for result in results:
+                key = result['_id']
+                counts[datetime(key['year'], key['month'], key['dayOfMonth'], key['hour'], key.get('minute', 0))] += result['count']
+        else:
+            query = _time_range('hour', start and bucket_hour(start), end)
+            if uuid:
+                query['uuid'] = uuid
+
+            first = start and start.replace(second=0, microsecond=0)
+            last = end and end.replace(second=0, microsecond=0)
+            for bucket in timestamp.find(query, {'hour': 1, 'count': 1, 'minutes': 1}):
+                hour = bucket['hour']
+                if interval == 'hour' and (not first or hour >= first) and (not last or hour + timedelta(minutes=59) <= last):
+                    counts[hour] += bucket['count']
+                    continue
+                # Only the minutes between start and end of an hour start or end cut through
+                for minute, count in bucket.get('minutes', {}).items():
+                    ts = hour + timedelta(minutes=int(minute))
+                    if (not first or ts >= first) and (not last or ts <= last):
+                        counts[hour if interval == 'hour' else ts] += count
+
+        return sorted(counts.items())
+
+
+def _time_range(field, start, end):
+    """
+    A query on field between start and end
+    """
+    query = {}
+    if start:
+        query['$gte'] = start
+    if end:
+        query['$lte'] = end
+    return {field: query} if query else {}
+
 
 class LogRecord(dict):
     """
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+    django-mongolog.  Simple Mongo based logger for Django
+    Copyright (C) 2015 - John Furr
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+
+# Different types for python2/3
+try:
+    text_type = unicode
+    binary_type = str
+    integer_types = (int, long)
+except NameError:
+    text_type = str
+    binary_type = None
+    integer_types = (int,)
+
+# Namespace of every log record uuid
+uuid_namespace = uuid.UUID('8296424f-28b7-5982-a434-e6ec8ef529b3')
+
+# Types that are stored as is.  bool is a subclass of int.
+PRIMITIVE_TYPES = (text_type, float, type(None)) + integer_types
+
+# Exact types for the fast path in normalize()
+_primitives = frozenset(PRIMITIVE_TYPES + (bool,))
+
+# Messages FingerprintCache caches
+_string_types = (text_type,) if binary_type is None else (text_type, binary_type)
+
+# Types KeySanitizer.sanitize() looks inside of
+_containers = (dict, list)
+
+
+def normalize(value):
+    """
+    Return a copy of value that only contains dicts, lists, strings, numbers,
+    booleans and None.  Tuples become lists and anything else becomes str(value).
+
+    This gives the same result as json.loads(json.dumps(value, default=str))
+    without building and parsing the intermediate json string.
+    """
+    value_type = type(value)
+    if value_type in _primitives:
+        return value
+
+    if value_type is dict or isinstance(value, dict):
+        return {
+            (k if type(k) is text_type else normalize_key(k)): (v if type(v) in _primitives else normalize(v))
+            for k, v in value.items()
+        }
+
+    if value_type is list or value_type is tuple or isinstance(value, (list, tuple)):
+        return [v if type(v) in _primitives else normalize(v) for v in value]
+
+    if isinstance(value, PRIMITIVE_TYPES):
+        # Subclasses of str, int and float
+        return value
+
+    if binary_type is not None and isinstance(value, binary_type):
+        # python 2 str.  json would have decoded it as utf-8
+        return value.decode('utf-8')
+
+    return str(value)
+
+
+def normalize_key(key):
+    """
+    Convert a dict key to a string the same way json.dumps does
+    """
+    if isinstance(key, text_type):
+        return key
+    if key is True:
+        return u'true'
+    if key is False:
+        return u'false'
+    if key is None:
+        return u'null'
+    if isinstance(key, float):
+        return text_type(repr(key))
+    if binary_type is not None and isinstance(key, binary_type):
+        return key.decode('utf-8')
+    return text_type(key)
+
+
+class KeySanitizer(object):
+    """
+    Rewrite the dict keys mongo won't store.
+
+    mongo < 3.6
+        Repalce . and $ with Unicode full width equivalents
+    mongo >= 3.6
+        As of mongo 3.6 . and $ are permitted in keys.  But keys may not start with $
+        If we encounter a key that starts with a $ we replace it with it's unicode full width equivalent.
+
+    If mongo_version is None the server version is unknown and the mongo < 3.6 rules are used.
+
+    The decision for each key string is cached.  Log messages tend to reuse the
+    same keys over and over so most keys are only ever looked at once.
+    """
+    def __init__(self, mongo_version=None, cache_size=10000):
+        self.mongo_version = mongo_version
+        self.cache_size = cache_size
+
+        # Keys known to be fine as they are and keys known to need rewriting
+        self._valid = set()
+        self._rewrites = {}
+
+    def new_key(self, key):
+        """
+        Return the key mongo will accept in place of key
+        """
+        if self.mongo_version is not None and self.mongo_version >= 3.6:
+            if key[:1] == "$":
+                key = u"＄" + key[1:]
+        else:
+            # Older mongo doesn't support $ or . in keys
+            if "." in key:
+                key = key.replace(u".", u"．")
+            elif "$" in key:
+                key = key.replace(u"$", u"＄")
+
+        return key
+
+    def rewrite(self, key):
+        """
+        Return the new key, or None if key can be stored as is
+        """
+        if key in self._valid:
+            return None
+        try:
+            return self._rewrites[key]
+        except KeyError:
+            pass
+
+        if len(self._valid) + len(self._rewrites) >= self.cache_size:
+            self._valid.clear()
+            self._rewrites.clear()
+
+        new_key = self.new_key(key)
+        if new_key == key:
+            self._valid.add(key)
+            return None
+
+        self._rewrites[key] = new_key
+        return new_key
+
+    def restore(self, value):
+        """
+        Undo the rewrites of every key of every dict nested anywhere in value, in place,
+        so value can be sanitized again with other rules.
+        """
+        stack = [value]
+        while stack:
+            node = stack.pop()
+            children = node.values() if isinstance(node, dict) else node
+            stack.extend(v for v in children if isinstance(v, _containers))
+            if isinstance(node, dict) and any(u"．" in k or u"＄" in k for k in node):
+                items = list(node.items())
+                node.clear()
+                for k, v in items:
+                    node[k.replace(u"．", u".").replace(u"＄", u"$")] = v
+        return value
+
+    def sanitize(self, value):
+        """
+        Rewrite the offending keys of every dict nested anywhere in value.
+
+        Dicts that only have valid keys are never modified.  Dicts that do are
+        rebuilt in place so their key order is kept.  The structure is walked
+        with an explicit stack so there is no limit on how deeply it's nested.
+        """
+        valid = self._valid
+        rewrite = self.rewrite
+        stack = [value]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                dirty = False
+                for k, v in node.items():
+                    if isinstance(v, _containers):
+                        stack.append(v)
+                    if not dirty and k not in valid:
+                        dirty = rewrite(k) is not None
+
+                if dirty:
+                    items = list(node.items())
+                    node.clear()
+                    for k, v in items:
+                        node[rewrite(k) or k] = v
+            else:
+                for v in node:
+                    if isinstance(v, _containers):
+                        stack.append(v)
+        return value
+
+
+def fingerprint(msg, levelname):
+    """
+    The uuid of a log record is a combination of the record.levelname and the record.msg
+    """
+    if sys.version_info.major >= 3:
+        uuid_key = str(msg) + str(levelname)
+    else:
+        uuid_key = (unicode(msg) + unicode(levelname)).encode('utf-8', 'replace')
+
+    return uuid.uuid5(uuid_namespace, uuid_key).hex
+
+
+class FingerprintCache(object):
+    """
+    LRU cache of fingerprint(msg, levelname) for string messages.
+
+    Only strings are cached, looked up by (msg, levelname).  Any other message
+    is hashed by its str(), and building that string costs about as much as
+    the SHA-1 it would save, so caching dicts and lists only adds a second
+    str() on every miss and keeps large payloads alive in the cache.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def uuid(self, msg, levelname):
+        if self.size <= 0 or not isinstance(msg, _string_types):
+            return fingerprint(msg, levelname)
+
+        key = (msg, levelname)
+        with self._lock:
+            value = self._cache.pop(key, None)
+            if value is not None:
+                # Move it to the most recently used end
+                self._cache[key] = value
+                self.hits += 1
+                return value
+
+        value = fingerprint(msg, levelname)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = value
+            if len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return value
+
+    def stats(self):
+        return {
+            'size': len(self._cache),
+            'max_size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def bucket_hour(ts):
+    """
+    The start of the hour ts falls in.  Timestamp buckets are keyed on it.
+    """
+    return ts.replace(minute=0, second=0, microsecond=0)
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+    django-mongolog.  Simple Mongo based logger for Django
+    Copyright (C) 2015 - John Furr
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import errno
+import os
+import re
+import threading
+import time
+
+from bson import json_util
+
+from mongolog.writers import write_safely
+
+# Read datetimes back the way they were logged: naive
+_LOADS_OPTIONS = {'json_options': json_util.JSONOptions(tz_aware=False)} if hasattr(json_util, 'JSONOptions') else {}
+
+# <name>-<YYYYmmddHHMMSS>-<writer pid>-<sequence>.<state>
+_SEGMENT = re.compile(r'^(?P<base>(?P<name>.+)-\d{14}-(?P<pid>\d+)-\d{6})\.(?P<state>open|spool|(?P<replayer>\d+)\.replay)$')
+
+OPEN = 'open'
+SEALED = 'spool'
+REPLAYING = 'replay'
+
+
+def pid_alive(pid):
+    """
+    True if a process with this pid exists
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Spool(object):
+    """
+    Append only spool of log records on local disk.
+
+    Records are appended as mongo extended json, one a line, to the open
+    segment file of this process.  Segments are sealed once they reach
+    segment_size bytes or when replay() starts.  The fsync policy decides how
+    much a crash can lose:
+
+        always:     fsync after every append
+        interval:   fsync at most every fsync_interval seconds
+        never:      leave it to the OS
+
+    replay(write) calls write(log_records) with batches of spooled records and
+    deletes each segment once all of it has been written.  The offset reached
+    is saved after every batch so an interrupted replay resumes where it
+    stopped.  Segments are renamed while they are replayed, so several
+    processes sharing the directory never replay the same segment twice.
+    Open segments of processes that died are replayed too.
+    """
+    ALWAYS = 'always'
+    INTERVAL = 'interval'
+    NEVER = 'never'
+    FSYNC_POLICIES = [ALWAYS, INTERVAL, NEVER]
+
+    def __init__(self, directory, name='mongolog', segment_size=64 * 1024 * 1024, fsync=INTERVAL, fsync_interval=1):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError("fsync must be one of %s" % self.FSYNC_POLICIES)
+
+        self.directory = directory
+        self.name = name
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+        # Number of records appended and replayed by this process
+        self.spooled = 0
+        self.replayed = 0
+
+        # Lines that couldn't be decoded during replay
+        self.corrupt = 0
+
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        self._seq = 0
+        self._synced = 0
+
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def _segment(self):
+        """
+        Return the open segment file of this process.  Must be called with self._lock held.
+        """
+        pid = os.getpid()
+        if self._file is not None and self._pid != pid:
+            # Opened by the parent before a fork.  The parent keeps writing to it.
+            self._file = None
+
+        if self._file is not None and self._file.tell() >= self.segment_size:
+            self._seal()
+
+        if self._file is None:
+            self._pid = pid
+            self._seq += 1
+            name = '%s-%s-%d-%06d.%s' % (self.name, time.strftime('%Y%m%d%H%M%S'), pid, self._seq, OPEN)
+            self._file = open(os.path.join(self.directory, name), 'ab')
+        return self._file
+
+    def _seal(self):
+        """
+        Close the open segment and make it available for replay.  Must be called with self._lock held.
+        """
+        f, self._file = self._file, None
+        if self.fsync != self.NEVER:
+            os.fsync(f.fileno())
+        f.close()
+        os.rename(f.name, f.name[:-len(OPEN)] + SEALED)
+
+    def seal(self):
+        """
+        Seal this process's open segment if it has any records
+        """
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid() and self._file.tell():
+                self._seal()
+
+    def close(self):
+        """
+        Seal the open segment, or remove it if nothing was written to it
+        """
+        self.seal()
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                f, self._file = self._file, None
+                f.close()
+                os.remove(f.name)
+
+    def append(self, log_records):
+        """
+        Append log records to the spool.  Returns the number appended.
+        """
+        data = b''.join((json_util.dumps(log_record) + '\n').encode('utf-8') for log_record in log_records)
+        if not data:
+            return 0
+
+        with self._lock:
+            f = self._segment()
+            f.write(data)
+            f.flush()
+            now = time.time()
+            if self.fsync == self.ALWAYS or (self.fsync == self.INTERVAL and now - self._synced >= self.fsync_interval):
+                os.fsync(f.fileno())
+                self._synced = now
+            self.spooled += len(log_records)
+        return len(log_records)
+
+    def segments(self):
+        """
+        Return [(path, state)] for every segment of this spool, oldest first
+        """
+        segments = []
+        for filename in sorted(os.listdir(self.directory)):
+            match = _SEGMENT.match(filename)
+            if match and match.group('name') == self.name:
+                state = REPLAYING if match.group('replayer') else match.group('state')
+                segments.append((os.path.join(self.directory, filename), state))
+        return segments
+
+    def replayable(self, path, state):
+        """
+        True if no other live process is writing or replaying the segment
+        """
+        match = _SEGMENT.match(os.path.basename(path))
+        if state == SEALED:
+            return True
+        if state == OPEN:
+            return int(match.group('pid')) != os.getpid() and not pid_alive(int(match.group('pid')))
+        # Left behind by a replay that failed in this process or by a process that died
+        replayer = int(match.group('replayer'))
+        return replayer == os.getpid() or not pid_alive(replayer)
+
+    def pending(self):
+        """
+        True if there is anything to replay
+        """
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid() and self._file.tell():
+                return True
+        return any(self.replayable(path, state) for path, state in self.segments())
+
+    def claim(self, path):
+        """
+        Rename the segment so no other process replays it.  Returns the new path or None if another process was faster.
+        """
+        base = _SEGMENT.match(os.path.basename(path)).group('base')
+        claimed = os.path.join(self.directory, '%s.%d.%s' % (base, os.getpid(), REPLAYING))
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            return None
+        return claimed
+
+    def replay(self, write, batch_size=1000):
+        """
+        Seal the open segment and write every replayable segment with write(log_records).
+        Returns the number of records replayed.  Anything write() raises stops the replay;
+        the records that weren't written stay in the spool.
+        """
+        if not self._replay_lock.acquire(False):
+            # Another thread of this process is replaying
+            return 0
+
+        try:
+            self.seal()
+            count = 0
+            for path, state in self.segments():
+                if not self.replayable(path, state):
+                    continue
+                claimed = self.claim(path)
+                if claimed:
+                    count += self.replay_segment(claimed, write, batch_size)
+            return count
+        finally:
+            self._replay_lock.release()
+
+    def replay_segment(self, path, write, batch_size=1000):
+        base = _SEGMENT.match(os.path.basename(path)).group('base')
+        offset_path = os.path.join(self.directory, base + '.offset')
+        offset = read_offset(offset_path)
+
+        count = 0
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            batch = []
+            for line in iter(f.readline, b''):
+                if not line.endswith(b'\n'):
+                    # Torn write from a crash
+                    self.corrupt += 1
+                    break
+                try:
+                    batch.append(json_util.loads(line.decode('utf-8'), **_LOADS_OPTIONS))
+                except ValueError:
+                    self.corrupt += 1
+
+                if len(batch) >= batch_size:
+                    count += self.write_batch(write, batch, offset_path, f.tell())
+                    batch = []
+
+            count += self.write_batch(write, batch, offset_path, f.tell())
+
+        os.remove(path)
+        if os.path.exists(offset_path):
+            os.remove(offset_path)
+        return count
+
+    def write_batch(self, write, batch, offset_path, offset):
+        if batch:
+            write(batch)
+            self.replayed += len(batch)
+        write_offset(offset_path, offset)
+        return len(batch)
+
+    def status(self):
+        """
+        Return [(path, state, size, records not replayed yet)] for every segment
+        """
+        status = []
+        for path, state in self.segments():
+            base = _SEGMENT.match(os.path.basename(path)).group('base')
+            with open(path, 'rb') as f:
+                f.seek(read_offset(os.path.join(self.directory, base + '.offset')))
+                records = sum(1 for line in f if line.endswith(b'\n'))
+            status.append((path, state, os.path.getsize(path), records))
+        return status
+
+
+def read_offset(path):
+    try:
+        with open(path) as f:
+            return int(f.read() or 0)
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def write_offset(path, offset):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+class ReplayWorker(object):
+    """
+    Daemon thread that calls replay() every interval seconds
+    """
+    def __init__(self, replay, interval=30, name='mongolog-replay'):
+        self.replay = replay
+        self.interval = interval
+        self.name = name
+        self.timeout = interval
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stopped = False
+
+    def start(self):
+        """
+        Start the thread.  Also called after a fork, since threads don't survive one.
+        """
+        with self._lock:
+            pid = os.getpid()
+            if self._stopped or (self._thread is not None and self._pid == pid):
+                return
+
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopped = True
+
+        if thread is not None and self._pid == os.getpid():
+            self._wakeup.set()
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not self._stopped:
+                write_safely(lambda _: self.replay(), None)
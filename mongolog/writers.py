@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+    django-mongolog.  Simple Mongo based logger for Django
+    Copyright (C) 2015 - John Furr
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+import atexit
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict, deque
+
+# Different imports for python2/3
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Sentinel put on the queue to tell the writer thread to exit
+_STOP = object()
+
+# Every writer that is alive in this process.  Drained by _stop_writers() at exit.
+_writers = weakref.WeakSet()
+
+
+class QueuedWriter(object):
+    """
+    Hand log records off to a background thread.
+
+    put() only enqueues the record into a bounded in memory queue.  A single
+    daemon thread drains the queue and calls write(log_records) with batches of
+    up to batch_size records.  After taking the first record of a batch the
+    thread waits at most batch_interval seconds for the batch to fill up.
+
+    When the queue is full the overflow policy decides what happens:
+
+        block:          wait for the writer thread to make room
+        drop_newest:    discard the record being put
+        drop_oldest:    discard the oldest queued record to make room
+
+    Discarded records are passed to on_drop(log_record) when it is set.
+    """
+    BLOCK = 'block'
+    DROP_NEWEST = 'drop_newest'
+    DROP_OLDEST = 'drop_oldest'
+    OVERFLOW_POLICIES = [BLOCK, DROP_NEWEST, DROP_OLDEST]
+
+    def __init__(
+            self, write, maxsize=10000, overflow=BLOCK, timeout=5, batch_size=100, batch_interval=0,
+            name='mongolog-writer', on_drop=None):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of %s" % self.OVERFLOW_POLICIES)
+
+        self.write = write
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.name = name
+
+        # Seconds to wait for the queue to drain when shutting down
+        self.timeout = timeout
+
+        # Max number of records passed to a single write() call
+        self.batch_size = max(1, batch_size)
+
+        # Seconds to wait for more records once a batch has been started
+        self.batch_interval = batch_interval
+
+        # Number of records discarded by the overflow policy
+        self.dropped = 0
+        self.on_drop = on_drop
+
+        self.queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopped = False
+
+        _writers.add(self)
+
+    def start(self):
+        """
+        Start the writer thread.  Threads don't survive a fork so this is
+        also called by put() when it notices it is running in a new process.
+        """
+        with self._lock:
+            pid = os.getpid()
+            if self._thread is not None and self._pid == pid:
+                return
+
+            if self._pid is not None and self._pid != pid:
+                # The parent's queue (and its locks) can't be trusted after a fork.
+                self.queue = queue.Queue(self.maxsize)
+
+            self._pid = pid
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def put(self, log_record):
+        """
+        Enqueue log_record for the writer thread.  Returns False if the record was dropped.
+        """
+        if self._stopped:
+            # Nothing is draining the queue anymore so write inline.
+            self._write([log_record])
+            return True
+
+        if self._pid != os.getpid():
+            self.start()
+
+        if self.overflow == self.BLOCK:
+            self.queue.put(log_record)
+            return True
+
+        if self.overflow == self.DROP_NEWEST:
+            try:
+                self.queue.put_nowait(log_record)
+            except queue.Full:
+                self._drop(log_record)
+                return False
+            return True
+
+        return self._put_drop_oldest(log_record)
+
+    def _put_drop_oldest(self, log_record):
+        while True:
+            try:
+                self.queue.put_nowait(log_record)
+                return True
+            except queue.Full:
+                pass
+
+            try:
+                dropped = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+
+            self.queue.task_done()
+            self._drop(dropped)
+
+    def _drop(self, log_record):
+        self.dropped += 1
+        if self.on_drop is not None:
+            write_safely(self.on_drop, log_record)
+
+    def flush(self, timeout=None):
+        """
+        Block until every queued record has been written or timeout seconds
+        have passed.  Returns True if the queue was fully drained.
+        """
+        if self._thread is None or self._pid != os.getpid():
+            return True
+
+        q = self.queue
+        deadline = None if timeout is None else time.time() + timeout
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                q.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        """
+        Write out everything still queued and stop the writer thread.
+        Any record put after stop() is written inline.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopped = True
+
+        if thread is None or self._pid != os.getpid():
+            return
+
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            stop = batch[0] is _STOP or self._fill(batch)
+            try:
+                log_records = [log_record for log_record in batch if log_record is not _STOP]
+                if log_records:
+                    self._write(log_records)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+            if stop:
+                return
+
+    def _fill(self, batch):
+        """
+        Add records to batch until it is full or batch_interval has passed.
+        Returns True if the stop sentinel was taken off the queue.
+        """
+        deadline = time.time() + self.batch_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    log_record = self.queue.get(timeout=remaining)
+                else:
+                    log_record = self.queue.get_nowait()
+            except queue.Empty:
+                return False
+
+            batch.append(log_record)
+            if log_record is _STOP:
+                return True
+        return False
+
+    def _write(self, log_records):
+        write_safely(self.write, log_records)
+
+
+class Aggregator(object):
+    """
+    Fold log records that share a uuid in memory and write each uuid once per window.
+
+    put() adds the record to the RecordGroup for its uuid.  A daemon thread
+    calls write(groups) with every group every 'window' seconds, or sooner
+    if more than max_groups distinct uuids have been seen.  Only the last
+    'keep' times of each group are kept when keep is set.
+    """
+    def __init__(self, write, window=1, max_groups=10000, keep=None, timeout=5, name='mongolog-aggregator'):
+        self.write = write
+        self.window = window
+        self.max_groups = max_groups
+        self.keep = keep
+        self.name = name
+
+        # Seconds to wait for the writer thread when shutting down
+        self.timeout = timeout
+
+        self.groups = OrderedDict()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stopped = False
+
+        _writers.add(self)
+
+    def start(self):
+        """
+        Start the writer thread.  Also called by put() after a fork.
+        """
+        with self._lock:
+            pid = os.getpid()
+            if self._thread is not None and self._pid == pid:
+                return
+
+            if self._pid is not None and self._pid != pid:
+                # Records folded before the fork belong to the parent
+                self.groups = OrderedDict()
+                self._write_lock = threading.Lock()
+
+            self._pid = pid
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def put(self, log_record):
+        if self._stopped:
+            # Nothing is flushing the groups anymore so write inline.
+            write_safely(self.write, list(group_records([log_record], self.keep).values()))
+            return True
+
+        if self._pid != os.getpid():
+            self.start()
+
+        with self._lock:
+            group = self.groups.get(log_record['uuid'])
+            if group is None:
+                self.groups[log_record['uuid']] = RecordGroup(log_record, self.keep)
+                full = len(self.groups) >= self.max_groups
+            else:
+                group.add(log_record)
+                full = False
+
+        if full:
+            self._wakeup.set()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Write every group now.  timeout is ignored since the calling thread does the writing.
+        """
+        with self._write_lock:
+            with self._lock:
+                groups, self.groups = self.groups, OrderedDict()
+
+            if groups:
+                write_safely(self.write, list(groups.values()))
+        return True
+
+    def stop(self, timeout=None):
+        """
+        Write every group and stop the writer thread.
+        Any record put after stop() is written inline.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopped = True
+
+        if thread is not None and self._pid == os.getpid():
+            self._wakeup.set()
+            thread.join(timeout)
+
+        self.flush()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.window)
+            self._wakeup.clear()
+            self.flush()
+
+
+def write_safely(write, arg):
+    try:
+        write(arg)
+    except Exception:
+        # Same behavior as logging.Handler.handleError.  We can't log the
+        # failure because that would most likely end up right back here.
+        if logging.raiseExceptions and sys.stderr:
+            traceback.print_exc(file=sys.stderr)
+
+
+class RecordGroup(object):
+    """
+    All of the buffered log records that share a uuid.
+
+    The group keeps the first and last record seen, the time of every
+    record (or only the last 'keep' times) and the total count.  A record
+    may already stand for several log calls, in which case it carries
+    'counter' and 'dates' keys.
+    """
+    def __init__(self, log_record, keep=None):
+        self.uuid = log_record['uuid']
+        self.first = log_record
+        self.last = log_record
+        self.count = 0
+        self.times = deque(maxlen=keep) if keep else []
+        self.add(log_record)
+
+    def add(self, log_record):
+        self.last = log_record
+        self.count += log_record.get('counter', 1)
+        self.times.extend(log_record.get('dates') or [log_record['time']])
+
+    def as_record(self, first=False):
+        """
+        A single log record standing for the whole group, with the count and
+        times in 'counter' and 'dates'.  The first record supplies the fields
+        if first is True, otherwise the last one.
+        """
+        log_record = dict(self.first if first else self.last)
+        log_record['counter'] = self.count
+        log_record['dates'] = list(self.times)
+        return log_record
+
+
+def group_records(log_records, keep=None):
+    """
+    Group log_records by uuid.  Returns an OrderedDict of uuid -> RecordGroup
+    in the order each uuid was first seen.
+    """
+    groups = OrderedDict()
+    for log_record in log_records:
+        group = groups.get(log_record['uuid'])
+        if group is None:
+            groups[log_record['uuid']] = RecordGroup(log_record, keep)
+        else:
+            group.add(log_record)
+    return groups
+
+
+def record_count(arg):
+    """
+    The number of log calls arg stands for: a log record, or a list of log records or RecordGroups
+    """
+    if isinstance(arg, dict):
+        return arg.get('counter', 1)
+    return sum(item.count if isinstance(item, RecordGroup) else item.get('counter', 1) for item in arg)
+
+
+@atexit.register
+def _stop_writers():
+    """
+    Flush every live writer on interpreter shutdown
+    """
+    for writer in list(_writers):
+        writer.stop(writer.timeout)
@@ -119,6 +119,57 @@ LOGGING = {
             'verbose': TEST_VERBOSITY,
             'record_type': 'reference',
         },
+        'test_queued': {
+            'level': 'DEBUG',
+            'class': 'mongolog.SimpleMongoLogHandler',
+            'connection': 'mongodb://localhost:27017',
+            'verbose': TEST_VERBOSITY,
+            'record_type': 'embedded',
+            'max_keep': 10,
+
+            # emit() only queues the record.  A background thread writes it to mongo
+            'queued': True,
+            'queue_size': 1000,
+            'overflow': 'block',
+
+            # Write up to 'batch_size' records at once.  Wait up to 'batch_interval' seconds to fill a batch
+            'batch_size': 100,
+            'batch_interval': 0.05,
+        },
+        'test_aggregated': {
+            'level': 'DEBUG',
+            'class': 'mongolog.SimpleMongoLogHandler',
+            'connection': 'mongodb://localhost:27017',
+            'verbose': TEST_VERBOSITY,
+            'record_type': 'embedded',
+            'max_keep': 10,
+
+            # Fold repeats of the same uuid in memory and write each uuid once every 'aggregate_window' seconds
+            'aggregate_window': 0.5,
+        },
+        'test_bucketed': {
+            'level': 'DEBUG',
+            'class': 'mongolog.SimpleMongoLogHandler',
+            'connection': 'mongodb://localhost:27017',
+            'verbose': TEST_VERBOSITY,
+            'record_type': 'reference',
+
+            # One timestamp document per uuid and hour
+            'timestamp_layout': 'buckets',
+            'bucket_keep': 5,
+        },
+        'test_capped': {
+            'level': 'DEBUG',
+            'class': 'mongolog.SimpleMongoLogHandler',
+            'connection': 'mongodb://localhost:27017',
+            'collection': 'test_capped',
+            'verbose': TEST_VERBOSITY,
+
+            # Append only inserts into a fixed size collection
+            'record_type': 'capped',
+            'capped_size': 1024 * 1024,
+            'capped_max': 1000,
+        },
         'test_console': {
             'level': 'DEBUG',
             'class': 'settings.colorlog.ColorLogHandler',
@@ -134,6 +185,8 @@ LOGGING = {
             'client_auth': 'http://192.168.33.51/4e487f07a84011e5a3403c15c2bcc424/',
             'verbose': TEST_VERBOSITY,
             'timeout': 1,
+            # Post inline so the connection errors reach the tests
+            'queued': False,
         },
     },
     'loggers': {
@@ -185,6 +238,18 @@ LOGGING = {
         'test.verbose': {
             'handlers': ['test_verbose'],
         },
+        'test.queued': {
+            'handlers': ['test_queued'],
+        },
+        'test.aggregated': {
+            'handlers': ['test_aggregated'],
+        },
+        'test.bucketed': {
+            'handlers': ['test_bucketed'],
+        },
+        'test.capped': {
+            'handlers': ['test_capped'],
+        },
         'test.http': {
             'level': 'DEBUG',
             'handlers': ['test_http_invalid'],